@@ -1,117 +1,1362 @@
 import flask
 from flask import request, Response, jsonify
 import yt_dlp
+from yt_dlp.utils import PlaylistEntries
 import os
+import re
+import sys
+import argparse
+import asyncio
 import threading
 import uuid
 import time
-from collections import defaultdict
+import heapq
+import random
+import itertools
+import json
+import sqlite3
+import zlib
+import shutil
+import filecmp
+import socket
+import subprocess
+import hashlib
+import gzip
+import mimetypes
+import tempfile
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+try:
+    import brotli  # optional, enables Brotli-compressed responses for the UI
+except ImportError:
+    brotli = None
+try:
+    import uvicorn  # optional, production server used by `python app.py serve`
+    from uvicorn.middleware.wsgi import WSGIMiddleware
+except ImportError:
+    uvicorn = None
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 
 app = flask.Flask(__name__)
-download_progress = {}
-download_lock = threading.Lock()
+download_progress = {}  # download_id -> JobProgress
+download_lock = threading.Lock()  # guards adding and removing download_progress entries
 
-def cleanup_old_downloads():
-    """Clean up downloads older than 1 hour"""
-    current_time = time.time()
+# Job progress records are guarded by sharded locks so concurrent jobs don't contend on one lock.
+# Each shard is a condition that is notified whenever a job in it changes.
+PROGRESS_LOCK_SHARDS = 16
+progress_shards = [threading.Condition() for _ in range(PROGRESS_LOCK_SHARDS)]
+async_waiters = {}  # download_id -> {(event loop, asyncio.Event)} of ASGI progress streams, guarded by the shard
+
+# Server settings (the compose file sets FLASK_HOST/FLASK_PORT)
+FLASK_HOST = os.environ.get('FLASK_HOST', '0.0.0.0')
+FLASK_PORT = int(os.environ.get('FLASK_PORT', 2070))
+WEB_WORKERS = max(1, int(os.environ.get('WEB_WORKERS', 1)))  # server processes for `serve`
+WEB_THREADS = max(1, int(os.environ.get('WEB_THREADS', 32)))  # threads per process for regular requests
+
+# Progress hook throttling: publish at most every PROGRESS_MIN_INTERVAL seconds
+# unless progress moved by at least PROGRESS_MIN_DELTA percent
+PROGRESS_MIN_INTERVAL = float(os.environ.get('PROGRESS_MIN_INTERVAL', 0.25))
+PROGRESS_MIN_DELTA = float(os.environ.get('PROGRESS_MIN_DELTA', 1.0))
+
+# Progress streaming settings
+PROGRESS_STREAM_HEARTBEAT = 15  # seconds between SSE keep-alive comments
+PROGRESS_LONG_POLL_MAX = 60  # upper bound for /progress?since=...&timeout=...
+
+# Background janitor: expiry of finished jobs and of stale partial files
+JOB_TTL_FINISHED = int(os.environ.get('JOB_TTL_FINISHED', 3600))  # seconds a finished job stays visible
+JOB_TTL_ERROR = int(os.environ.get('JOB_TTL_ERROR', 3600))  # seconds a failed job stays visible
+MAX_TRACKED_JOBS = max(1, int(os.environ.get('MAX_TRACKED_JOBS', 10000)))  # oldest ended jobs go first
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 30))
+PARTIAL_FILE_TTL = int(os.environ.get('PARTIAL_FILE_TTL', 24 * 3600))  # age before orphaned .part files are removed
+PARTIAL_FILE_SUFFIXES = ('.part', '.ytdl', '.temp.mp3', '.test_write')
+expiry_heap = []  # (expires_at, download_id) of ended jobs, oldest first
+expiry_lock = threading.Lock()
+DEFAULT_DOWNLOAD_DIR = './music'  # owned by the service, so any stale partial file in it is an orphan
+partial_files = set()  # partial files this process's jobs wrote, dropped once they are gone
+partial_files_lock = threading.Lock()
+
+# Client delivery: jobs submitted with "delivery": "client" download into a scratch directory per
+# job and the file is sent to the browser; the directory is removed when the job expires
+STREAM_DIR = os.environ.get('STREAM_DIR', os.path.join(tempfile.gettempdir(), 'video-downloader-streams'))
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Client-chosen download_id/batch_id values end up in file and directory names
+JOB_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# Download scheduler settings
+MAX_CONCURRENT_DOWNLOADS = max(1, int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 3)))
+MAX_QUEUE_SIZE = max(0, int(os.environ.get('MAX_QUEUE_SIZE', 100)))
+
+MAX_BATCH_SIZE = max(1, int(os.environ.get('MAX_BATCH_SIZE', 1000)))
+MAX_BATCH_BACKLOG = max(MAX_BATCH_SIZE, int(os.environ.get('MAX_BATCH_BACKLOG', 10000)))
+# Batch items take at most half of the queue, the other half stays free for single submissions
+BATCH_QUEUE_LIMIT = max(1, MAX_QUEUE_SIZE - MAX_QUEUE_SIZE // 2)
+
+job_queue = []  # heap of (priority, sequence, download_id, job kwargs)
+job_queue_cond = threading.Condition()
+job_sequence = itertools.count()
+active_jobs = set()
+download_workers = []
+download_batches = {}  # batch_id -> {'created_at': ..., 'items': [(download_id, url), ...], 'pending': deque}
+batch_backlog = []  # heap of (priority, sequence, pending deque) of batches with items not queued yet, guarded by job_queue_cond
+
+# Playlist items downloaded concurrently within one job
+PLAYLIST_CONCURRENCY = max(1, int(os.environ.get('PLAYLIST_CONCURRENCY', 1)))
+MAX_PLAYLIST_CONCURRENCY = max(PLAYLIST_CONCURRENCY, int(os.environ.get('MAX_PLAYLIST_CONCURRENCY', 8)))
+playlist_progress = {}  # download_id -> aggregate state of in-flight playlist items
+
+# Persistent extraction cache (SQLite in the config volume)
+CONFIG_DIR = os.environ.get('CONFIG_DIR', './config')
+EXTRACTION_CACHE_PATH = os.environ.get('EXTRACTION_CACHE_PATH', os.path.join(CONFIG_DIR, 'extraction_cache.sqlite3'))
+EXTRACTION_CACHE_TTL = int(os.environ.get('EXTRACTION_CACHE_TTL', 1800))  # seconds, 0 disables the cache
+EXTRACTION_CACHE_MAX_ENTRIES = max(1, int(os.environ.get('EXTRACTION_CACHE_MAX_ENTRIES', 1000)))
+# Longer playlist listings (e.g. whole channels) are not cached, they are read lazily every time
+EXTRACTION_CACHE_MAX_PLAYLIST_ENTRIES = max(0, int(os.environ.get('EXTRACTION_CACHE_MAX_PLAYLIST_ENTRIES', 1000)))
+extraction_cache_lock = threading.Lock()
+extraction_cache_db = None
+extraction_cache_stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+# Archive of finished downloads, used to skip or hard-link media we already have
+DOWNLOAD_ARCHIVE_PATH = os.environ.get('DOWNLOAD_ARCHIVE_PATH', os.path.join(CONFIG_DIR, 'download_archive.sqlite3'))
+download_archive_lock = threading.Lock()
+download_archive_db = None
+
+# Library index of downloaded files (SQLite FTS5), updated as jobs finish and searched by /library
+LIBRARY_PATH = os.environ.get('LIBRARY_PATH', os.path.join(CONFIG_DIR, 'library.sqlite3'))
+LIBRARY_PAGE_SIZE = 50
+LIBRARY_MAX_PAGE_SIZE = 500
+library_lock = threading.Lock()
+library_db = None
+library_fts = True  # False if this SQLite build lacks FTS5; search then falls back to LIKE
+
+# Global download bandwidth budget in bytes/sec (e.g. '10M'), shared fairly by active transfers
+GLOBAL_RATE_LIMIT = yt_dlp.utils.parse_bytes(os.environ['GLOBAL_RATE_LIMIT']) if os.environ.get('GLOBAL_RATE_LIMIT') else None
+FRAGMENTED_PROTOCOLS = ('m3u8', 'http_dash_segments', 'ism', 'f4m')  # prefixes of yt-dlp's fragment protocols
+
+# Segmented transfers: number of parallel range requests for large progressive HTTP files
+# and of concurrent fragment downloads for DASH/HLS (1 = off)
+DOWNLOAD_SEGMENTS = max(1, int(os.environ.get('DOWNLOAD_SEGMENTS', 1)))
+MAX_DOWNLOAD_SEGMENTS = max(DOWNLOAD_SEGMENTS, int(os.environ.get('MAX_DOWNLOAD_SEGMENTS', 16)))
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024  # smaller files are not worth splitting
+SEGMENT_CHUNK_SIZE = 256 * 1024
+
+# Retry policy: transient failures (network trouble, throttling, server errors) are retried with
+# exponential backoff and jitter, and the next attempt resumes from the .part file
+RETRY_ATTEMPTS = max(1, int(os.environ.get('RETRY_ATTEMPTS', 3)))  # attempts per video, including the first
+RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF', 2))  # seconds before the first retry, doubled each time
+RETRY_BACKOFF_MAX = float(os.environ.get('RETRY_BACKOFF_MAX', 60))
+
+# Idle YoutubeDL instances kept for reuse, so jobs with the same options skip extractor setup
+# and keep their HTTP connections to the CDNs warm
+YDL_POOL_SIZE = max(0, int(os.environ.get('YDL_POOL_SIZE', 8)))
+
+# MP3 conversion runs as its own pipeline stage: a pool of ffmpeg processes sized to the CPU
+# cores, so a playlist keeps downloading item N+1 while item N is being transcoded
+POSTPROCESS_WORKERS = max(1, int(os.environ.get('POSTPROCESS_WORKERS', os.cpu_count() or 1)))
+MP3_QUALITY = os.environ.get('MP3_QUALITY', '192')  # kbit/s
+postprocess_pool = ThreadPoolExecutor(max_workers=POSTPROCESS_WORKERS, thread_name_prefix='postprocess')
+postprocess_jobs = {}  # download_id -> pending conversions of the job, guarded by its progress shard
+
+# Metrics: latency histogram buckets (seconds) for each download phase
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+PHASES = ('directory_check', 'extraction', 'transfer', 'postprocessing')
+metrics_lock = threading.Lock()
+job_results = defaultdict(int)  # (status, error_class) -> count
+item_failures = defaultdict(int)  # error_class -> failed playlist items
+postprocessor_starts = {}  # (thread id, postprocessor) -> start time
+
+# Job store: 'memory' keeps jobs in this process only, 'sqlite' persists them in the config
+# volume so they survive restarts and can be shared by several worker processes
+JOB_STORE = os.environ.get('JOB_STORE', 'memory').lower()
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', os.path.join(CONFIG_DIR, 'jobs.sqlite3'))
+JOB_HEARTBEAT_INTERVAL = 10  # seconds between owner heartbeats / orphaned job scans
+JOB_OWNER_TIMEOUT = 30  # a process missing heartbeats this long is considered dead
+PROCESS_OWNER = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+def schedule_expiry(download_id, status):
+    """Queue an ended job for removal once its TTL has passed. Returns the expiry time."""
+    expires_at = time.time() + (JOB_TTL_ERROR if status == 'error' else JOB_TTL_FINISHED)
+    with expiry_lock:
+        heapq.heappush(expiry_heap, (expires_at, download_id))
+    return expires_at
+
+def expire_jobs(now=None):
+    """Drop ended jobs whose TTL passed, plus the oldest ended jobs beyond MAX_TRACKED_JOBS.
+    Work is proportional to the number of expired jobs, not to all tracked jobs."""
+    now = now or time.time()
+    expired = []
+    scratch_dirs = []
+    with expiry_lock:
+        while expiry_heap and (expiry_heap[0][0] <= now or len(download_progress) - len(expired) > MAX_TRACKED_JOBS):
+            expires_at, download_id = heapq.heappop(expiry_heap)
+            job = download_progress.get(download_id)
+            # Skip stale heap entries: job already gone, resumed, or rescheduled later
+            if job is not None and job.expires_at == expires_at:
+                expired.append(download_id)
+    if expired:
+        with download_lock:
+            for download_id in expired:
+                job = download_progress.pop(download_id, None)
+                if job is not None and job.scratch_dir:
+                    scratch_dirs.append(job.scratch_dir)
+        for path in scratch_dirs:
+            remove_stream_dir(path)
     with download_lock:
-        to_remove = []
-        for download_id, data in download_progress.items():
-            if current_time - data.get('created_at', current_time) > 3600:  # 1 hour
-                to_remove.append(download_id)
-        for download_id in to_remove:
-            del download_progress[download_id]
-
-def update_progress(download_id, status, progress=0, message='', current_item=0, total_items=1, item_name=''):
+        for batch_id in [batch_id for batch_id, batch in download_batches.items()
+                         if now - batch['created_at'] > max(JOB_TTL_FINISHED, JOB_TTL_ERROR)
+                         and not batch['pending']]:
+            del download_batches[batch_id]
+    job_store.expire_jobs(now - JOB_TTL_FINISHED, now - JOB_TTL_ERROR)
+    return len(expired)
+
+def track_partial_file(path):
+    """Remember a partial file a job is writing, so the janitor may remove it if it is left behind"""
+    if path and path not in partial_files:
+        with partial_files_lock:
+            partial_files.add(path)
+            if path.endswith('.part'):
+                partial_files.add(path[:-5] + '.ytdl')  # fragment downloads keep their state next to it
+
+def remove_orphaned_partial_files(now=None):
+    """Delete stale .part/temp files left behind by interrupted or crashed jobs: any in the default
+    download directory, elsewhere (custom paths may be shared with other programs) only those
+    this process's jobs wrote"""
+    cutoff = (now or time.time()) - PARTIAL_FILE_TTL
+    removed = 0
+    candidates = []
+    try:
+        with os.scandir(DEFAULT_DOWNLOAD_DIR) as entries:
+            candidates = [entry.path for entry in entries
+                          if entry.name.endswith(PARTIAL_FILE_SUFFIXES) and entry.is_file()]
+    except OSError:
+        pass
+    with partial_files_lock:
+        candidates.extend(partial_files)
+    for path in candidates:
+        try:
+            if os.stat(path).st_mtime >= cutoff:
+                continue
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass  # finished and renamed, or removed by its job
+        except OSError as e:
+            print(f"Could not remove partial file {path}: {e}")
+            continue
+        with partial_files_lock:
+            partial_files.discard(path)
+    return removed
+
+def remove_orphaned_stream_dirs(now=None):
+    """Delete client delivery directories of jobs that are gone, e.g. from before a restart. With a shared
+    job store, directories of jobs another worker process still tracks are left to that process."""
+    cutoff = (now or time.time()) - max(JOB_TTL_FINISHED, JOB_TTL_ERROR)
+    removed = 0
+    try:
+        with os.scandir(STREAM_DIR) as entries:
+            for entry in entries:
+                try:
+                    if (entry.is_dir(follow_symlinks=False) and entry.name not in download_progress
+                            and entry.stat().st_mtime < cutoff
+                            and not (job_store.shared and job_store.load_progress(entry.name) is not None)):
+                        shutil.rmtree(entry.path)
+                        removed += 1
+                except OSError as e:
+                    print(f"Could not remove stream directory {entry.path}: {e}")
+    except OSError:
+        pass
+    return removed
+
+def stream_dir(download_id):
+    """Scratch directory of a client delivery job"""
+    return os.path.join(STREAM_DIR, download_id)
+
+def remove_stream_dir(path):
+    """Delete a client delivery scratch directory, refusing anything that is not directly inside STREAM_DIR"""
+    root = os.path.realpath(STREAM_DIR)
+    path = os.path.realpath(path)
+    if os.path.dirname(path) != root:
+        print(f"Refusing to remove {path}: not a stream directory")
+        return
+    shutil.rmtree(path, ignore_errors=True)
+
+def janitor():
+    """Background loop expiring ended jobs and cleaning up partial files"""
+    last_file_scan = 0
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            expire_jobs()
+            # Directory scans are comparatively expensive, run them at most hourly
+            if time.time() - last_file_scan > min(PARTIAL_FILE_TTL, 3600):
+                last_file_scan = time.time()
+                remove_orphaned_partial_files()
+                remove_orphaned_stream_dirs()
+        except Exception as e:
+            print(f"Janitor error: {e}")
+
+def start_janitor():
+    """Start the background janitor thread"""
+    thread = threading.Thread(target=janitor, name='janitor')
+    thread.daemon = True
+    thread.start()
+
+def ensure_download_workers():
+    """Start the fixed-size worker pool on first use"""
+    with job_queue_cond:
+        while len(download_workers) < MAX_CONCURRENT_DOWNLOADS:
+            worker = threading.Thread(target=download_worker, name=f'download-worker-{len(download_workers) + 1}')
+            worker.daemon = True
+            worker.start()
+            download_workers.append(worker)
+
+def enqueue_download(download_id, job, priority=0):
+    """Queue a download job. Returns False when the queue is full."""
+    return enqueue_downloads([(download_id, job)], priority)
+
+def enqueue_downloads(jobs, priority=0):
+    """Queue several (download_id, job) pairs at once, all or nothing. Returns False when they don't fit."""
+    ensure_download_workers()
+    with job_queue_cond:
+        if len(job_queue) + len(jobs) > MAX_QUEUE_SIZE:
+            return False
+        for download_id, job in jobs:
+            heapq.heappush(job_queue, (priority, next(job_sequence), download_id, job))
+        job_queue_cond.notify(len(jobs))
+    return True
+
+def enqueue_batch(jobs, priority=0, bounded=True):
+    """Queue a batch's (download_id, job) pairs. Items that don't fit in the batch share of the queue wait
+    in a backlog that workers feed into the queue as they free up. Returns the deque of waiting items,
+    or None when the backlog is full. Jobs that were accepted before (resumed ones) pass bounded=False."""
+    ensure_download_workers()
+    with job_queue_cond:
+        room = max(0, BATCH_QUEUE_LIMIT - len(job_queue))
+        pending = deque(jobs[room:])
+        if (bounded and pending
+                and sum(len(entry[2]) for entry in batch_backlog) + len(pending) > MAX_BATCH_BACKLOG):
+            return None
+        for download_id, job in jobs[:room]:
+            heapq.heappush(job_queue, (priority, next(job_sequence), download_id, job))
+        if pending:
+            heapq.heappush(batch_backlog, (priority, next(job_sequence), pending))
+        job_queue_cond.notify(min(room, len(jobs)))
+    return pending
+
+def feed_batch_backlog():
+    """Move waiting batch items into the queue while the batch share has room, highest priority batch first.
+    Caller must hold job_queue_cond. Returns the number of items queued."""
+    fed = 0
+    while batch_backlog and len(job_queue) < BATCH_QUEUE_LIMIT:
+        priority, _, pending = batch_backlog[0]
+        download_id, job = pending.popleft()
+        heapq.heappush(job_queue, (priority, next(job_sequence), download_id, job))
+        fed += 1
+        if not pending:
+            heapq.heappop(batch_backlog)
+    return fed
+
+def queue_position(download_id):
+    """1-based position of a pending job in the queue, or None if not queued"""
+    with job_queue_cond:
+        for position, entry in enumerate(sorted(job_queue), 1):
+            if entry[2] == download_id:
+                return position
+    return None
+
+def download_worker():
+    """Worker loop: run queued downloads one at a time, highest priority first"""
+    while True:
+        with job_queue_cond:
+            while not job_queue:
+                job_queue_cond.wait()
+            _, _, download_id, job = heapq.heappop(job_queue)
+            active_jobs.add(download_id)
+            fed = feed_batch_backlog()
+            if fed:
+                job_queue_cond.notify(fed)
+        try:
+            download_file(download_id=download_id, **job)
+        except Exception as e:
+            print(f"Worker error for {download_id}: {e}")
+        finally:
+            with job_queue_cond:
+                active_jobs.discard(download_id)
+
+class JobProgress:
+    """Progress record of one job. Fields are guarded by the job's shard lock."""
+    __slots__ = ('status', 'progress', 'message', 'current_item', 'total_items', 'item_name', 'speed',
+                 'extractions', 'created_at', 'expires_at', 'version', 'hook_time', 'hook_percent', 'files',
+                 'partial_file', 'retries', 'failed_items', 'scratch_dir')
+
+    def __init__(self):
+        self.status = 'unknown'
+        self.progress = 0
+        self.message = ''
+        self.current_item = 0
+        self.total_items = 1
+        self.item_name = ''
+        self.speed = 0  # current download throughput in bytes/sec
+        self.extractions = 0
+        self.created_at = time.time()
+        self.expires_at = None  # set once the job has ended
+        self.version = 0
+        self.hook_time = 0.0  # last time the progress hook published, for throttling
+        self.hook_percent = -100.0
+        self.files = []  # finished output files, in completion order
+        self.partial_file = None  # file being written by a single-format download, for live streaming
+        self.retries = 0  # retried attempts over all items of the job
+        self.failed_items = []  # playlist items that failed for good, with their URL for a re-run
+        self.scratch_dir = None  # client delivery directory, removed when the job expires
+
+    def snapshot(self):
+        """Consistent copy for API responses. Caller must hold the shard lock."""
+        return {
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'current_item': self.current_item,
+            'total_items': self.total_items,
+            'item_name': self.item_name,
+            'speed': self.speed,
+            'extractions': self.extractions,
+            'created_at': self.created_at,
+            'version': self.version,
+            'files_count': len(self.files),  # the files themselves are listed by /download/file
+            'retries': self.retries,
+            'failed_items': list(self.failed_items),
+        }
+
+def progress_shard(download_id):
+    """Lock/condition guarding a job's progress record"""
+    return progress_shards[hash(download_id) % PROGRESS_LOCK_SHARDS]
+
+def get_job(download_id):
+    """Progress record for a job, created on first use. Caller must hold the shard lock."""
+    job = download_progress.get(download_id)
+    if job is None:
+        with download_lock:
+            job = download_progress.setdefault(download_id, JobProgress())
+    return job
+
+def record_job_file(download_id, path):
+    """Remember a finished output file of a job, so the client can fetch it from /download/file"""
+    path = os.path.abspath(path)
+    with progress_shard(download_id):
+        job = download_progress.get(download_id)
+        if job is None or path in job.files:
+            return
+        job.files.append(path)
+        job.partial_file = None
+    if job_store.shared:
+        job_store.add_file(download_id, path)
+
+def get_job_files(download_id):
+    """Finished output files of a job, in completion order, or None if the job is unknown"""
+    with progress_shard(download_id):
+        job = download_progress.get(download_id)
+        if job is not None:
+            return list(job.files)
+    if job_store.shared:
+        return job_store.load_files(download_id)
+    return None
+
+def update_progress(download_id, status, progress=0, message='', current_item=0, total_items=1, item_name='', speed=0):
     """Thread-safe progress update"""
+    shard = progress_shard(download_id)
+    with shard:
+        job = get_job(download_id)
+        if (job.status == status and job.progress == progress and job.message == message
+                and job.current_item == current_item and job.total_items == total_items
+                and job.item_name == item_name and job.speed == speed):
+            return  # nothing changed, don't wake up listeners
+        job.status = status
+        job.progress = progress
+        job.message = message
+        job.current_item = current_item
+        job.total_items = total_items
+        job.item_name = item_name
+        job.speed = speed
+        if status in ('finished', 'error'):
+            job.expires_at = schedule_expiry(download_id, status)
+        else:
+            job.expires_at = None
+        job.version += 1
+        if job_store.shared:  # other workers read progress from the store; nobody else does
+            job_store.save_progress(download_id, job.snapshot())
+        shard.notify_all()
+        for loop, event in async_waiters.get(download_id, ()):
+            loop.call_soon_threadsafe(event.set)
+
+def get_progress(download_id, since=None, timeout=0):
+    """Snapshot of a job's progress. With `since`, wait up to `timeout` seconds for a newer version."""
+    if download_id not in download_progress and job_store.shared:
+        data = get_stored_progress(download_id, since, timeout)
+        if data is not None:
+            return data
+
+    shard = progress_shard(download_id)
+    with shard:
+        if since is not None and timeout > 0:
+            shard.wait_for(lambda: getattr(download_progress.get(download_id), 'version', 0) > since, timeout)
+        job = download_progress.get(download_id)
+        data = job.snapshot() if job is not None else None
+    if data is not None and data['status'] == 'queued':
+        data['queue_position'] = queue_position(download_id)
+    return data
+
+async def get_progress_async(download_id, since, timeout):
+    """Coroutine version of get_progress for the ASGI front end: waiting costs no thread"""
+    loop = asyncio.get_running_loop()
+    if download_id not in download_progress and job_store.shared:
+        deadline = loop.time() + timeout
+        while True:
+            data = await loop.run_in_executor(None, job_store.load_progress, download_id)
+            if data is None or data.get('version', 0) > since or loop.time() >= deadline:
+                break
+            await asyncio.sleep(0.5)
+        if data is not None:
+            return data
+
+    event = asyncio.Event()
+    waiter = (loop, event)
+    with progress_shard(download_id):
+        job = download_progress.get(download_id)
+        if job is None or job.version <= since:
+            async_waiters.setdefault(download_id, set()).add(waiter)
+        else:
+            event.set()
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        with progress_shard(download_id):
+            waiters = async_waiters.get(download_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del async_waiters[download_id]
+    return get_progress(download_id)
+
+def get_stored_progress(download_id, since=None, timeout=0):
+    """Progress of a job owned by another worker process, read from the shared job store"""
+    deadline = time.monotonic() + (timeout if since is not None else 0)
+    while True:
+        data = job_store.load_progress(download_id)
+        if data is None or since is None or data.get('version', 0) > since or time.monotonic() >= deadline:
+            return data
+        time.sleep(0.5)
+
+def progress_hook_due(last_time, last_percent, percent, now):
+    """Throttle hook updates: True if enough time passed or progress moved enough since the last one"""
+    return (percent >= 100 or now - last_time >= PROGRESS_MIN_INTERVAL
+            or abs(percent - last_percent) >= PROGRESS_MIN_DELTA)
+
+class Histogram:
+    """Cumulative latency histogram in the Prometheus style"""
+    __slots__ = ('buckets', 'counts', 'total', 'count', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+            self.total += value
+            self.count += 1
+
+    def render(self, name, labels):
+        """Prometheus text lines for this histogram"""
+        with self.lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+        return lines
+
+phase_latency = {phase: Histogram(PHASE_BUCKETS) for phase in PHASES}
+
+@contextmanager
+def timed_phase(phase):
+    """Record how long the enclosed block took in the phase's latency histogram"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        phase_latency[phase].observe(time.monotonic() - start)
+
+def error_class(e):
+    """Name of the root exception class, unwrapping yt-dlp's DownloadError"""
+    exc_info = getattr(e, 'exc_info', None)
+    if exc_info and exc_info[1] is not None:
+        return type(exc_info[1]).__name__
+    return type(e).__name__
+
+def is_transient_error(e):
+    """Whether a failure is worth retrying: network trouble, throttling and server errors are;
+    unavailable, private, geo-blocked or unsupported videos and ffmpeg failures are not"""
+    exc_info = getattr(e, 'exc_info', None)
+    exc = exc_info[1] if exc_info and exc_info[1] is not None else e
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, yt_dlp.networking.exceptions.HTTPError):
+            return exc.status in (408, 425, 429) or exc.status >= 500
+        if isinstance(exc, (yt_dlp.networking.exceptions.TransportError, yt_dlp.utils.ContentTooShortError,
+                            ConnectionError, TimeoutError)):
+            return True
+        if isinstance(exc, (yt_dlp.utils.UnsupportedError, yt_dlp.utils.GeoRestrictedError,
+                            yt_dlp.utils.PostProcessingError)):
+            return False
+        # Extractors wrap network failures, e.g. "Unable to download webpage", with the cause attached
+        exc = getattr(exc, 'cause', None) or exc.__cause__
+    return False
+
+def retry_delay(attempt):
+    """Backoff before retry number `attempt`: exponential, capped, with jitter so retries spread out"""
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+def with_retries(action, download_id, what):
+    """Run action(), retrying transient failures per the retry policy. The final error is
+    re-raised with the number of retries spent on it in its `retries` attribute."""
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            return action()
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS or not is_transient_error(e):
+                e.retries = attempt - 1
+                raise
+            delay = retry_delay(attempt)
+            print(f"{what} failed for {download_id} (attempt {attempt} of {RETRY_ATTEMPTS}), "
+                  f"retrying in {delay:.1f}s: {e}")
+            with progress_shard(download_id):
+                job = download_progress.get(download_id)
+                if job is not None:
+                    job.retries += 1
+                    # Same status and progress, only the message changes
+                    update_progress(download_id, job.status, job.progress,
+                                    f'{what} failed, retrying in {delay:.0f}s '
+                                    f'(attempt {attempt + 1} of {RETRY_ATTEMPTS})...',
+                                    job.current_item, job.total_items, job.item_name)
+            time.sleep(delay)
+
+def record_job_result(status, exception=None):
+    """Count a finished job by outcome and error class"""
+    with metrics_lock:
+        job_results[(status, error_class(exception) if exception else '')] += 1
+
+def postprocessor_timing_hook(d):
+    """Time ffmpeg post-processing steps (yt-dlp postprocessor hook)"""
+    name = d.get('postprocessor') or ''
+    if not name.startswith('FFmpeg'):
+        return
+    key = (threading.get_ident(), name)
+    if d['status'] == 'started':
+        postprocessor_starts[key] = time.monotonic()
+    elif d['status'] == 'finished' and key in postprocessor_starts:
+        phase_latency['postprocessing'].observe(time.monotonic() - postprocessor_starts.pop(key))
+
+class BandwidthAllocator:
+    """Shares the global bandwidth budget between active transfers with max-min fairness.
+
+    Every job gets an equal share of GLOBAL_RATE_LIMIT, jobs capped below their share
+    (per-job rate_limit) give the rest back to the others, and a job's allocation is split
+    evenly between its concurrent transfers. Limits are enforced by yt-dlp itself. Its HTTP
+    downloader (and segmented_download) re-read params['ratelimit'] on every chunk, so shares
+    adapt mid-transfer whenever a transfer starts or finishes. DASH/HLS downloads copy the
+    params once when they start and limit every concurrent fragment on its own: they get
+    their share divided by the number of fragment streams and keep it until they finish.
+    """
+
+    def __init__(self, total_limit):
+        self.total_limit = total_limit
+        self.lock = threading.Lock()
+        self.transfers = {}  # id(ydl) -> (download_id, ydl, concurrent streams limited separately)
+        self.job_limits = {}  # download_id -> per-job cap in bytes/sec or None
+
+    def add(self, download_id, ydl, job_limit=None, streams=1):
+        with self.lock:
+            self.transfers[id(ydl)] = (download_id, ydl, streams)
+            self.job_limits[download_id] = job_limit
+            self.rebalance()
+
+    def remove(self, ydl):
+        with self.lock:
+            download_id, _, _ = self.transfers.pop(id(ydl), (None, None, None))
+            if download_id is not None and all(d != download_id for d, _, _ in self.transfers.values()):
+                self.job_limits.pop(download_id, None)
+            self.rebalance()
+
+    def rebalance(self):
+        """Recompute every transfer's ratelimit. Caller must hold self.lock."""
+        jobs = defaultdict(list)
+        for download_id, ydl, streams in self.transfers.values():
+            jobs[download_id].append((ydl, streams))
+
+        remaining = self.total_limit
+        # Smallest caps first so unused share flows to uncapped jobs
+        order = sorted(jobs, key=lambda d: self.job_limits.get(d) or float('inf'))
+        for index, download_id in enumerate(order):
+            cap = self.job_limits.get(download_id)
+            if remaining is None:
+                allocation = cap
+            else:
+                share = remaining / (len(order) - index)
+                allocation = min(cap, share) if cap else share
+                remaining -= allocation
+            for ydl, streams in jobs[download_id]:
+                ydl.params['ratelimit'] = (max(1, int(allocation / len(jobs[download_id]) / streams))
+                                           if allocation else None)
+
+    def stats(self):
+        with self.lock:
+            return {'global_limit': self.total_limit, 'active_transfers': len(self.transfers),
+                    'active_jobs': len(self.job_limits)}
+
+def fragment_streams(ydl, info):
+    """Number of separately rate-limited connections yt-dlp opens for info: DASH/HLS formats
+    fetch concurrent_fragment_downloads fragments at a time, everything else counts as one"""
+    for fmt in info.get('requested_formats') or [info]:
+        if fmt.get('fragments') or str(fmt.get('protocol') or '').startswith(FRAGMENTED_PROTOCOLS):
+            return max(1, ydl.params.get('concurrent_fragment_downloads') or 1)
+    return 1
+
+@contextmanager
+def bandwidth_share(download_id, ydl, rate_limit=None, info=None):
+    """Register a YoutubeDL instance with the bandwidth allocator while it downloads info"""
+    bandwidth.add(download_id, ydl, rate_limit, fragment_streams(ydl, info) if info else 1)
+    try:
+        yield
+    finally:
+        bandwidth.remove(ydl)
+
+class MemoryJobStore:
+    """Default job store: jobs only live in this process's download_progress"""
+    shared = False
+
+    def add_job(self, download_id, job, priority):
+        pass
+
+    def add_jobs(self, jobs, priority):
+        pass
+
+    def save_progress(self, download_id, state):
+        pass
+
+    def load_progress(self, download_id):
+        return None
+
+    def add_file(self, download_id, path):
+        pass
+
+    def load_files(self, download_id):
+        return None
+
+    def remove_jobs(self, download_ids):
+        pass
+
+    def expire_jobs(self, finished_before, error_before):
+        pass
+
+    def add_batch(self, batch_id, items):
+        pass
+
+    def load_batch(self, batch_id):
+        return None
+
+    def heartbeat(self):
+        pass
+
+    def claim_orphaned_jobs(self):
+        return []
+
+class SQLiteJobStore:
+    """Job store in a SQLite (WAL) file shared by every worker process using the same config volume"""
+    shared = True
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = open_sqlite(path, [
+            '''CREATE TABLE IF NOT EXISTS jobs (
+                   download_id TEXT PRIMARY KEY,
+                   params TEXT NOT NULL,
+                   priority INTEGER NOT NULL,
+                   owner TEXT,
+                   status TEXT NOT NULL,
+                   state TEXT,
+                   created_at REAL NOT NULL,
+                   updated_at REAL NOT NULL)''',
+            'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)',
+            '''CREATE TABLE IF NOT EXISTS job_owners (
+                   owner TEXT PRIMARY KEY,
+                   heartbeat REAL NOT NULL)''',
+            '''CREATE TABLE IF NOT EXISTS batches (
+                   batch_id TEXT NOT NULL,
+                   position INTEGER NOT NULL,
+                   download_id TEXT NOT NULL,
+                   url TEXT NOT NULL,
+                   created_at REAL NOT NULL,
+                   PRIMARY KEY (batch_id, position))''',
+            '''CREATE TABLE IF NOT EXISTS job_files (
+                   download_id TEXT NOT NULL,
+                   path TEXT NOT NULL,
+                   PRIMARY KEY (download_id, path))''',
+        ])
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            try:
+                cursor = self.db.execute(sql, params)
+                self.db.commit()
+                return cursor
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+                return None
+
+    def add_job(self, download_id, job, priority):
+        self.add_jobs([(download_id, job)], priority)
+
+    def add_jobs(self, jobs, priority):
+        now = time.time()
+        with self.lock:
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO jobs (download_id, params, priority, owner, status, '
+                                    'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    [(download_id, json.dumps(job), priority, PROCESS_OWNER, 'queued', now, now)
+                                     for download_id, job in jobs])
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+
+    def save_progress(self, download_id, state):
+        self.execute('UPDATE jobs SET status = ?, state = ?, updated_at = ? WHERE download_id = ?',
+                     (state['status'], json.dumps(state), time.time(), download_id))
+
+    def load_progress(self, download_id):
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT state FROM jobs WHERE download_id = ?', (download_id,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+                return None
+        return json.loads(row[0]) if row and row[0] else None
+
+    def add_file(self, download_id, path):
+        self.execute('INSERT OR IGNORE INTO job_files (download_id, path) VALUES (?, ?)', (download_id, path))
+
+    def load_files(self, download_id):
+        """A job's files in the order they were added, or None if the job is unknown"""
+        with self.lock:
+            try:
+                if self.db.execute('SELECT 1 FROM jobs WHERE download_id = ?', (download_id,)).fetchone() is None:
+                    return None
+                rows = self.db.execute('SELECT path FROM job_files WHERE download_id = ? ORDER BY rowid',
+                                       (download_id,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+                return None
+        return [row[0] for row in rows]
+
+    def remove_jobs(self, download_ids):
+        with self.lock:
+            try:
+                self.db.executemany('DELETE FROM jobs WHERE download_id = ?', [(i,) for i in download_ids])
+                self.db.executemany('DELETE FROM job_files WHERE download_id = ?', [(i,) for i in download_ids])
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+
+    def expire_jobs(self, finished_before, error_before):
+        self.execute("DELETE FROM jobs WHERE (status = 'finished' AND updated_at < ?) "
+                     "OR (status = 'error' AND updated_at < ?)", (finished_before, error_before))
+        self.execute('DELETE FROM job_files WHERE download_id NOT IN (SELECT download_id FROM jobs)')
+        self.execute('DELETE FROM batches WHERE created_at < ?', (min(finished_before, error_before),))
+
+    def add_batch(self, batch_id, items):
+        now = time.time()
+        with self.lock:
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO batches (batch_id, position, download_id, url, created_at) '
+                                    'VALUES (?, ?, ?, ?, ?)',
+                                    [(batch_id, position, download_id, url, now)
+                                     for position, (download_id, url) in enumerate(items)])
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+
+    def load_batch(self, batch_id):
+        with self.lock:
+            try:
+                rows = self.db.execute('SELECT download_id, url FROM batches WHERE batch_id = ? ORDER BY position',
+                                       (batch_id,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+                return None
+        return [tuple(row) for row in rows] or None
+
+    def heartbeat(self):
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO job_owners (owner, heartbeat) VALUES (?, ?)', (PROCESS_OWNER, now))
+        self.execute('DELETE FROM job_owners WHERE heartbeat < ?', (now - JOB_OWNER_TIMEOUT,))
+
+    def claim_orphaned_jobs(self):
+        """Take over unfinished jobs whose owning process is gone. Returns [(download_id, job, priority, state)]."""
+        claimed = []
+        with self.lock:
+            try:
+                rows = self.db.execute(
+                    '''SELECT download_id, params, priority, owner, state FROM jobs
+                       WHERE status NOT IN ('finished', 'error')
+                         AND (owner IS NULL OR owner NOT IN (SELECT owner FROM job_owners))
+                       ORDER BY created_at, rowid''').fetchall()
+                for download_id, params, priority, owner, state in rows:
+                    # Conditional update so only one process wins each job
+                    cursor = self.db.execute('UPDATE jobs SET owner = ? WHERE download_id = ? AND owner IS ?',
+                                             (PROCESS_OWNER, download_id, owner))
+                    if cursor.rowcount == 1:
+                        claimed.append((download_id, json.loads(params), priority,
+                                        json.loads(state) if state else None))
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Job store error: {e}")
+        return claimed
+
+def create_job_store():
+    """Job store backend selected by JOB_STORE"""
+    if JOB_STORE == 'sqlite':
+        return SQLiteJobStore(JOB_STORE_PATH)
+    if JOB_STORE != 'memory':
+        print(f"Unknown JOB_STORE '{JOB_STORE}', using in-memory job store")
+    return MemoryJobStore()
+
+def resume_orphaned_jobs():
+    """Re-queue interrupted jobs; yt-dlp continues their .part files where they stopped.
+    They were accepted before, so they go through the batch backlog rather than being refused
+    when they don't all fit in the queue."""
+    resumed = defaultdict(list)  # priority -> [(download_id, job)], in submission order
+    for download_id, job, priority, state in job_store.claim_orphaned_jobs():
+        with progress_shard(download_id):
+            record = get_job(download_id)
+            if state:
+                record.created_at = state.get('created_at', record.created_at)
+                record.version = state.get('version', 0)
+                record.files = [path for path in job_store.load_files(download_id) or [] if os.path.isfile(path)]
+        update_progress(download_id, 'queued', 0, 'Resuming interrupted download...')
+        resumed[priority].append((download_id, job))
+    for priority, jobs in resumed.items():
+        enqueue_batch(jobs, priority, bounded=False)
+        print(f"Resumed {len(jobs)} interrupted download(s)")
+
+def job_store_maintenance():
+    """Background loop: heartbeat this process and adopt jobs from dead processes"""
+    while True:
+        try:
+            job_store.heartbeat()
+            resume_orphaned_jobs()
+        except Exception as e:
+            print(f"Job store maintenance error: {e}")
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+
+def start_job_store_maintenance():
+    """Start the heartbeat/resume thread for shared job stores"""
+    if job_store.shared:
+        job_store.heartbeat()
+        thread = threading.Thread(target=job_store_maintenance, name='job-store-maintenance')
+        thread.daemon = True
+        thread.start()
+
+def forget_jobs(download_ids):
+    """Drop jobs that were never accepted"""
     with download_lock:
-        download_progress[download_id] = {
-            'status': status,
-            'progress': progress,
-            'message': message,
-            'current_item': current_item,
-            'total_items': total_items,
-            'item_name': item_name,
-            'created_at': download_progress.get(download_id, {}).get('created_at', time.time())
-        }
+        for download_id in download_ids:
+            download_progress.pop(download_id, None)
+    job_store.remove_jobs(download_ids)
+
+def normalize_url(url):
+    """Canonical form of a URL for cache keys: lowercase scheme/host, sorted query, no fragment"""
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+def open_sqlite(path, schema):
+    """Open a SQLite database shared between threads and create its schema"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    for statement in schema:
+        db.execute(statement)
+    db.commit()
+    return db
+
+def get_extraction_cache():
+    """Open the extraction cache database on first use. Caller must hold extraction_cache_lock."""
+    global extraction_cache_db
+    if extraction_cache_db is None:
+        extraction_cache_db = open_sqlite(EXTRACTION_CACHE_PATH, [
+            '''CREATE TABLE IF NOT EXISTS extraction_cache (
+                   cache_key TEXT PRIMARY KEY,
+                   info BLOB NOT NULL,
+                   created_at REAL NOT NULL,
+                   last_used REAL NOT NULL)''',
+            'CREATE INDEX IF NOT EXISTS extraction_cache_last_used ON extraction_cache (last_used)',
+        ])
+    return extraction_cache_db
+
+def extraction_cache_get(cache_key):
+    """Return a fresh cached info dict or None"""
+    now = time.time()
+    with extraction_cache_lock:
+        try:
+            db = get_extraction_cache()
+            row = db.execute('SELECT info, created_at FROM extraction_cache WHERE cache_key = ?',
+                             (cache_key,)).fetchone()
+            if row is None:
+                extraction_cache_stats['misses'] += 1
+                return None
+            if now - row[1] > EXTRACTION_CACHE_TTL:
+                db.execute('DELETE FROM extraction_cache WHERE cache_key = ?', (cache_key,))
+                db.commit()
+                extraction_cache_stats['expired'] += 1
+                extraction_cache_stats['misses'] += 1
+                return None
+            db.execute('UPDATE extraction_cache SET last_used = ? WHERE cache_key = ?', (now, cache_key))
+            db.commit()
+            extraction_cache_stats['hits'] += 1
+            return json.loads(zlib.decompress(row[0]))
+        except (sqlite3.Error, OSError, ValueError, zlib.error) as e:
+            print(f"Extraction cache read failed: {e}")
+            return None
+
+def extraction_cache_put(cache_key, info):
+    """Store an info dict, evicting the least recently used entries beyond the size cap"""
+    now = time.time()
+    with extraction_cache_lock:
+        try:
+            db = get_extraction_cache()
+            db.execute('INSERT OR REPLACE INTO extraction_cache (cache_key, info, created_at, last_used) '
+                       'VALUES (?, ?, ?, ?)',
+                       (cache_key, zlib.compress(json.dumps(info).encode('utf-8')), now, now))
+            evicted = db.execute('''DELETE FROM extraction_cache WHERE cache_key IN (
+                                        SELECT cache_key FROM extraction_cache
+                                        ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                                 (EXTRACTION_CACHE_MAX_ENTRIES,)).rowcount
+            db.commit()
+            extraction_cache_stats['evictions'] += max(evicted, 0)
+        except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+            print(f"Extraction cache write failed: {e}")
+
+def extraction_cache_key(ydl, url, extra_info=None):
+    """Cache key of a URL's metadata: the normalized URL and the selected format, plus the fields
+    a playlist adds to its entries (they end up in the processed info)"""
+    cache_key = f"{normalize_url(url)}|{ydl.params.get('format')}"
+    if extra_info:
+        digest = hashlib.sha256(json.dumps(extra_info, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        cache_key += f'|{digest[:16]}'
+    return cache_key
+
+def extraction_cache_delete(cache_key):
+    """Drop a cached info dict, e.g. one whose media URLs have expired"""
+    with extraction_cache_lock:
+        try:
+            db = get_extraction_cache()
+            db.execute('DELETE FROM extraction_cache WHERE cache_key = ?', (cache_key,))
+            db.commit()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Extraction cache delete failed: {e}")
+
+def extract_info(ydl, url, download_id, refresh=False, ie_key=None, extra_info=None):
+    """Resolve a URL's metadata once, counting the round-trip in the job status. `ie_key` and `extra_info`
+    are passed on to yt-dlp, as for playlist entries that point to another URL.
+    With refresh, the cache is not consulted (but still updated).
+    Returns (info, whether it came from the cache)."""
+    use_cache = EXTRACTION_CACHE_TTL > 0
+    cache_key = extraction_cache_key(ydl, url, extra_info)
+    if use_cache and not refresh:
+        info = extraction_cache_get(cache_key)
+        if info is not None:
+            return info, True
+
+    with progress_shard(download_id):
+        get_job(download_id).extractions += 1
+    info = ydl.extract_info(url, download=False, ie_key=ie_key, extra_info=extra_info)
+    if info is not None and use_cache:
+        extraction_cache_put(cache_key, ydl.sanitize_info(info))
+    return info, False
+
+def extract_listing(ydl, url, download_id, refresh=False):
+    """Resolve a URL without expanding playlists. A single video comes back fully processed (and
+    cached); a playlist comes back as its flat listing, whose entries are fetched lazily, or as the
+    listing cached by cache_playlist_listing. With refresh, the cache is not consulted.
+    Returns (info, whether it came from the cache)."""
+    use_cache = EXTRACTION_CACHE_TTL > 0
+    cache_key = extraction_cache_key(ydl, url)
+    if use_cache and not refresh:
+        info = extraction_cache_get(cache_key)
+        if info is not None:
+            return info, True
+
+    ie_key = None
+    for _ in range(10):  # follow redirects to other extractors, as yt-dlp would
+        with progress_shard(download_id):
+            get_job(download_id).extractions += 1
+        info = ydl.extract_info(url, download=False, ie_key=ie_key, process=False)
+        if info is None or info.get('_type') != 'url':
+            break
+        url, ie_key = info['url'], info.get('ie_key')
+    if info is None or info.get('_type') in ('playlist', 'multi_video'):
+        return info, False
+
+    info = ydl.process_ie_result(info, download=False)
+    if info is not None and use_cache:
+        extraction_cache_put(cache_key, ydl.sanitize_info(info))
+    return info, False
 
-def download_file(url, file_format, download_id, custom_path=None):
+def read_playlist_entries(ydl, url, entries, download_id):
+    """Yield the entries of a playlist listing as its pages are fetched. A failed page is retried
+    per the retry policy by reading the listing again and skipping the entries already yielded,
+    since a listing generator that raised can't be resumed."""
+    items = entries.get_requested_items()
+    read = 0
+
+    def next_entry():
+        nonlocal items
+        if items is None:
+            listing, _ = extract_listing(ydl, url, download_id, refresh=True)
+            if listing is None or 'entries' not in listing:
+                raise Exception('Could not extract playlist information')
+            items = itertools.islice(PlaylistEntries(ydl, listing).get_requested_items(), read, None)
+        try:
+            return next(items)
+        except StopIteration:
+            return None
+        except Exception:
+            items = None
+            raise
+
+    while True:
+        item = with_retries(next_entry, download_id, 'Reading playlist')
+        if item is None:
+            return
+        read += 1
+        yield item[1]
+
+def cache_playlist_listing(ydl, url, info, listing):
+    """Store a playlist's flat listing once it has been read completely, so submitting the same playlist
+    again skips extraction while the entry is fresh. Entries are resolved per video as usual."""
+    playlist = {key: value for key, value in info.items() if key != 'entries'}
+    playlist['entries'] = listing
+    extraction_cache_put(extraction_cache_key(ydl, url), ydl.sanitize_info(playlist))
+
+def playlist_entry_defaults(playlist):
+    """Fields yt-dlp copies from a playlist into entries that don't set them"""
+    defaults = {key: playlist[key] for key in ('extractor', 'extractor_key', 'webpage_url',
+                                               'webpage_url_basename', 'webpage_url_domain')
+                if playlist.get(key)}
+    defaults.update({'playlist': playlist.get('title') or playlist.get('id'), 'playlist_id': playlist.get('id'),
+                     'playlist_title': playlist.get('title')})
+    return defaults
+
+def resolve_playlist_entry(ydl, entry, defaults, download_id, listing_url=None):
+    """Full metadata of a flat playlist entry, resolved right before it downloads. `listing_url` is set when
+    the entry comes from the cached listing of that playlist. Returns (info, refresh), where refresh
+    re-extracts info that came from the cache (see download_action) and is None otherwise."""
+    if entry.get('_type') == 'url' and entry.get('url'):
+        # As yt-dlp's process_ie_result would: the entry's extractor, with the playlist's fields added
+        options = {'ie_key': entry.get('ie_key'), 'extra_info': defaults}
+        info, cached = extract_info(ydl, entry['url'], download_id, **options)
+        refresh = lambda: refresh_extraction(ydl, entry['url'], download_id, extract_info, **options)
+        return info, refresh if cached else None
+    info = ydl.process_ie_result(dict(entry), download=False, extra_info=defaults)
+    if not listing_url:
+        return info, None
+    return info, lambda: refresh_listing_entry(ydl, listing_url, entry, defaults, download_id)
+
+def refresh_extraction(ydl, url, download_id, extract, **options):
+    """Fresh metadata of a URL whose cached info went stale: drop the cache entry and extract it again"""
+    extraction_cache_delete(extraction_cache_key(ydl, url, options.get('extra_info')))
+    with timed_phase('extraction'):
+        return extract(ydl, url, download_id, refresh=True, **options)[0]
+
+def refresh_listing_entry(ydl, url, entry, defaults, download_id):
+    """Fresh metadata of an inline entry of a stale cached playlist listing: read the listing again,
+    cache it in place of the stale one and resolve the entry with the same id"""
+    info = refresh_extraction(ydl, url, download_id, extract_listing)
+    if info is None or 'entries' not in info:
+        return None
+    listing = [fresh for _, fresh in PlaylistEntries(ydl, info).get_requested_items()]
+    cache_playlist_listing(ydl, url, info, listing)
+    for fresh in listing:
+        if fresh and fresh.get('id') == entry.get('id'):
+            return ydl.process_ie_result(dict(fresh), download=False, extra_info=defaults)
+    return None
+
+def output_template(download_dir):
+    """yt-dlp output template for files saved in download_dir"""
+    return os.path.join(download_dir, '%(title)s.%(ext)s')
+
+def build_ydl_opts(file_format, download_dir, progress_hook, segments=1):
+    """yt-dlp options shared by single videos and playlist items"""
+    ydl_opts = {
+        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+        'outtmpl': output_template(download_dir),
+        'progress_hooks': [progress_hook],
+        'postprocessor_hooks': [postprocessor_timing_hook],
+        'ignoreerrors': False,  # errors must reach with_retries; items fail independently anyway
+        'continuedl': True,  # resume from .part files left by interrupted jobs
+        'concurrent_fragment_downloads': segments,  # DASH/HLS fragments fetched in parallel
+        'extract_flat': False,
+        'no_warnings': True,
+        'quiet': True,
+    }
+
+    if file_format == 'mp3':
+        # Conversion to MP3 happens in the post-processing pool, see Mp3ConvertPP
+        ydl_opts['format'] = 'bestaudio/best'
+    return ydl_opts
+
+def download_file(url, file_format, download_id, custom_path=None, playlist_concurrency=None, rate_limit=None,
+                  segments=None, delivery='server'):
     """Enhanced download function with better progress tracking"""
     try:
         update_progress(download_id, 'starting', 0, 'Initializing download...')
         
         # Set download directory
-        download_dir = custom_path if custom_path else './music'
+        if delivery == 'client':
+            download_dir = stream_dir(download_id)
+            with progress_shard(download_id):
+                get_job(download_id).scratch_dir = download_dir
+        else:
+            download_dir = custom_path if custom_path else DEFAULT_DOWNLOAD_DIR
         
         # Ensure directory exists and is accessible
         try:
-            os.makedirs(download_dir, exist_ok=True)
-            # Test write permissions
-            test_file = os.path.join(download_dir, '.test_write')
-            with open(test_file, 'w') as f:
-                f.write('test')
-            os.remove(test_file)
+            with timed_phase('directory_check'):
+                os.makedirs(download_dir, exist_ok=True)
+                # Test write permissions (one probe file per job, jobs share directories)
+                test_file = os.path.join(download_dir, f'.{download_id}.test_write')
+                with open(test_file, 'w') as f:
+                    f.write('test')
+                os.remove(test_file)
         except Exception as e:
             raise Exception(f"Cannot access download directory '{download_dir}': {str(e)}")
         
-        ydl_opts = {
-            'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-            'outtmpl': os.path.join(download_dir, '%(title)s.%(ext)s'),
-            'progress_hooks': [lambda d: update_progress_hook(d, download_id)],
-            'ignoreerrors': True,
-            'extract_flat': False,
-            'no_warnings': True,
-            'quiet': True,
-        }
+        segments = segments or DOWNLOAD_SEGMENTS
+        live = False  # read by the hook at call time, set once the format is known
+        hook = lambda d: update_progress_hook(d, download_id, live=live)
 
-        if file_format == 'mp3':
-            ydl_opts['format'] = 'bestaudio/best'
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.checkout(file_format, download_dir, segments, download_id, hook) as ydl:
             update_progress(download_id, 'extracting', 5, 'Extracting video information...')
-            info = ydl.extract_info(url, download=False)
+            def extract():
+                with timed_phase('extraction'):
+                    return extract_listing(ydl, url, download_id)
+            info, cached = with_retries(extract, download_id, 'Extraction')
+            if info is None:
+                raise Exception('Could not extract video information')
             
             if 'entries' in info:
-                # Playlist handling
-                entries = [entry for entry in info['entries'] if entry is not None]
-                total = len(entries)
-                update_progress(download_id, 'downloading_multiple', 10, 
-                              f'Found {total} videos in playlist', 0, total)
+                # Playlist handling: the listing is read lazily and each entry is resolved by the
+                # worker that downloads it, so the first items start before the listing is complete
+                entries = PlaylistEntries(ydl, info)
+                known_total = entries.get_full_count() or info.get('playlist_count')
+                if known_total:
+                    update_progress(download_id, 'downloading_multiple', 10,
+                                  f'Found {known_total} videos in playlist', 0, known_total)
+                else:
+                    update_progress(download_id, 'downloading_multiple', 10, 'Reading playlist...', 0, 0)
+                
+                workers = playlist_concurrency or PLAYLIST_CONCURRENCY
+                if known_total:
+                    workers = min(workers, known_total)
+                defaults = playlist_entry_defaults(info)
+                slots = threading.Semaphore(workers)  # only read further entries when a worker is free
+                total = 0
+                # Entries read so far, cached once the listing is complete unless it is too long
+                listing = [] if not cached and EXTRACTION_CACHE_TTL > 0 else None
+                start_playlist_tracking(download_id, known_total)
+                try:
+                    with ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix=f'playlist-{download_id}') as pool:
+                        for entry in read_playlist_entries(ydl, url, entries, download_id):
+                            if listing is not None:
+                                listing.append(entry)
+                                if len(listing) > EXTRACTION_CACHE_MAX_PLAYLIST_ENTRIES:
+                                    listing = None
+                            if entry is None:
+                                continue
+                            slots.acquire()
+                            total += 1
+                            playlist_item_discovered(download_id, total)
+                            future = pool.submit(download_playlist_entry, entry, total, file_format,
+                                                 download_dir, download_id, rate_limit, segments, defaults,
+                                                 url if cached else None)
+                            future.add_done_callback(lambda _: slots.release())
+                        playlist_listing_finished(download_id, total)
+                        if listing is not None:
+                            cache_playlist_listing(ydl, url, info, listing)
+                finally:
+                    stop_playlist_tracking(download_id)
                 
-                for count, entry in enumerate(entries, 1):
-                    try:
-                        item_name = entry.get('title', f'Video {count}')
-                        update_progress(download_id, 'downloading_multiple', 
-                                      10 + (count-1) * 80 / total, 
-                                      f'Downloading: {item_name}', 
-                                      count, total, item_name)
-                        
-                        ydl.download([entry['webpage_url']])
-                        
-                        progress = 10 + count * 80 / total
-                        update_progress(download_id, 'downloading_multiple', progress, 
-                                      f'Completed: {item_name}', count, total, item_name)
-                        
-                    except Exception as e:
-                        print(f"Error downloading {entry.get('title', 'unknown')}: {e}")
-                        continue
+                # Conversions overlapped with the downloads; wait for the ones still running
+                for item, error in wait_for_postprocessing(download_id):
+                    print(f"Error converting playlist item: {error}")
+                    with metrics_lock:
+                        item_failures[error_class(error)] += 1
+                    if item:
+                        record_failed_item(download_id, *item, error)
                 
-                update_progress(download_id, 'finished', 100, 
-                              f'Successfully downloaded {total} videos!')
+                failed = len(get_progress(download_id)['failed_items'])
+                if failed:
+                    update_progress(download_id, 'finished', 100,
+                                  f'Downloaded {total - failed} of {total} videos, {failed} failed')
+                else:
+                    update_progress(download_id, 'finished', 100, 
+                                  f'Successfully downloaded {total} videos!')
+                record_job_result('finished')
             else:
                 # Single video handling
                 item_name = info.get('title', 'Video')
+                # A single progressive file can be streamed while it downloads; merged formats,
+                # fragments and MP3 conversions only make sense once finished
+                live = (file_format != 'mp3' and not info.get('requested_formats')
+                        and info.get('protocol') in ('http', 'https'))
                 update_progress(download_id, 'downloading', 10, 
                               f'Downloading: {item_name}', 1, 1, item_name)
-                ydl.download([url])
-                update_progress(download_id, 'finished', 100, 'Download completed!')
+                # Download from the already-extracted info instead of resolving the URL again
+                # A retried transfer resumes from the .part file of the failed attempt
+                # Cached info may carry expired media URLs: if so, extract it again once
+                refresh = (lambda: refresh_extraction(ydl, url, download_id, extract_listing)) if cached else None
+                with bandwidth_share(download_id, ydl, rate_limit, info):
+                    reused = with_retries(download_action(ydl, info, refresh, file_format, download_dir, download_id),
+                                          download_id, 'Download')
+                errors = wait_for_postprocessing(download_id)
+                if errors:
+                    raise errors[0][1]
+                if reused:
+                    update_progress(download_id, 'finished', 100, 'Already downloaded!', 1, 1, item_name)
+                else:
+                    update_progress(download_id, 'finished', 100, 'Download completed!')
+                record_job_result('finished')
                 
     except Exception as e:
+        with progress_shard(download_id):
+            postprocess_jobs.pop(download_id, None)
+        record_job_result('error', e)
         error_msg = str(e)
         if 'Video unavailable' in error_msg:
             error_msg = 'Video is unavailable or private'
@@ -119,38 +1364,740 @@ def download_file(url, file_format, download_id, custom_path=None):
             error_msg = 'Network error. Please check your connection.'
         update_progress(download_id, 'error', 0, error_msg)
 
-def update_progress_hook(d, download_id):
-    """Progress hook for yt-dlp downloads"""
-    if d['status'] == 'downloading':
+def download_playlist_entry(entry, count, file_format, download_dir, download_id, rate_limit=None, segments=1,
+                            defaults=None, listing_url=None):
+    """Resolve and download one playlist item with its own YoutubeDL instance; failures only affect this item.
+    `listing_url` is the playlist's URL if the entry comes from its cached listing."""
+    item_name = entry.get('title') or f'Video {count}'
+    url = entry.get('webpage_url') or entry.get('url')
+    playlist_item_started(download_id, count, item_name)
+    try:
+        hook = lambda d: update_progress_hook(d, download_id, count)
+        with ydl_pool.checkout(file_format, download_dir, segments, download_id, hook,
+                               (count, item_name, url)) as ydl:
+            def resolve():
+                with timed_phase('extraction'):
+                    return resolve_playlist_entry(ydl, entry, defaults or {}, download_id, listing_url)
+            info, refresh = with_retries(resolve, download_id, f'Extracting {item_name}')
+            if info is None:
+                raise Exception('Could not extract video information')
+            with bandwidth_share(download_id, ydl, rate_limit, info):
+                with_retries(download_action(ydl, info, refresh, file_format, download_dir, download_id),
+                             download_id, f'Downloading {item_name}')
+    except Exception as e:
+        print(f"Error downloading {item_name}: {e}")
+        with metrics_lock:
+            item_failures[error_class(e)] += 1
+        record_failed_item(download_id, count, item_name, url, e)
+    finally:
+        playlist_item_finished(download_id, count)
+
+def record_failed_item(download_id, count, item_name, url, error):
+    """Keep a playlist item that failed for good in the job status, so it can be submitted again"""
+    with progress_shard(download_id):
+        job = download_progress.get(download_id)
+        if job is not None:
+            job.failed_items.append({'index': count, 'title': item_name, 'url': url, 'error': str(error),
+                                     'transient': is_transient_error(error),
+                                     'retries': getattr(error, 'retries', 0)})
+
+def start_playlist_tracking(download_id, total=None):
+    """Begin aggregate progress tracking for a playlist job; `total` is None while the listing is unread"""
+    with progress_shard(download_id):
+        playlist_progress[download_id] = {'total': total or 0, 'completed': 0, 'active': {}, 'last_name': ''}
+
+def playlist_item_discovered(download_id, count):
+    """Count an entry read from a playlist listing whose length isn't known in advance"""
+    with progress_shard(download_id):
+        state = playlist_progress.get(download_id)
+        if state is not None and count > state['total']:
+            state['total'] = count
+
+def playlist_listing_finished(download_id, total):
+    """The listing is exhausted: fix the playlist's final item count"""
+    with progress_shard(download_id):
+        state = playlist_progress.get(download_id)
+        if state is not None and state['total'] != total:
+            state['total'] = total
+            report_playlist_progress(download_id, f'Found {total} videos in playlist')
+
+def stop_playlist_tracking(download_id):
+    """Drop aggregate playlist state once the job is done"""
+    with progress_shard(download_id):
+        playlist_progress.pop(download_id, None)
+
+def playlist_item_started(download_id, count, item_name):
+    """Mark a playlist item as in flight"""
+    with progress_shard(download_id):
+        state = playlist_progress.get(download_id)
+        if state is None:
+            return
+        state['active'][count] = [item_name, 0.0, 0.0, 0]  # name, percent, last hook publish time, speed
+        state['last_name'] = item_name
+        report_playlist_progress(download_id, f'Downloading: {item_name}')
+
+def playlist_item_finished(download_id, count):
+    """Mark a playlist item as done, whether it succeeded or failed"""
+    with progress_shard(download_id):
+        state = playlist_progress.get(download_id)
+        if state is None:
+            return
+        item_name = state['active'].pop(count, [f'Video {count}'])[0]
+        state['completed'] += 1
+        report_playlist_progress(download_id, f'Completed: {item_name}')
+
+def report_playlist_progress(download_id, message):
+    """Publish aggregate playlist progress across all in-flight items.
+    Caller must hold the job's shard lock so concurrent items publish in order."""
+    state = playlist_progress.get(download_id)
+    if state is None:
+        return
+    total = max(state['total'], 1)
+    done = state['completed'] + sum(item[1] for item in state['active'].values()) / 100
+    current_item = min(total, state['completed'] + len(state['active']))
+    speed = sum(item[3] for item in state['active'].values())
+    update_progress(download_id, 'downloading_multiple', 10 + done * 80 / total,
+                    message, current_item, state['total'], state['last_name'], speed)
+
+def get_download_archive():
+    """Open the download archive database on first use. Caller must hold download_archive_lock."""
+    global download_archive_db
+    if download_archive_db is None:
+        download_archive_db = open_sqlite(DOWNLOAD_ARCHIVE_PATH, [
+            '''CREATE TABLE IF NOT EXISTS download_archive (
+                   archive_key TEXT NOT NULL,
+                   filepath TEXT NOT NULL,
+                   created_at REAL NOT NULL,
+                   PRIMARY KEY (archive_key, filepath))''',
+        ])
+    return download_archive_db
+
+def archive_key(info, file_format):
+    """Identify downloaded media by extractor, video id and requested format"""
+    extractor = info.get('extractor_key') or info.get('extractor')
+    video_id = info.get('id')
+    if not extractor or not video_id:
+        return None
+    return f'{extractor} {video_id} {file_format}'
+
+def archive_record(key, filepath):
+    """Remember where a finished download was written"""
+    with download_archive_lock:
+        try:
+            db = get_download_archive()
+            db.execute('INSERT OR REPLACE INTO download_archive (archive_key, filepath, created_at) VALUES (?, ?, ?)',
+                       (key, os.path.abspath(filepath), time.time()))
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Download archive write failed: {e}")
+
+def archive_lookup(key):
+    """Paths of existing files recorded for an archive key; stale rows are pruned"""
+    with download_archive_lock:
+        try:
+            db = get_download_archive()
+            paths = [row[0] for row in db.execute(
+                'SELECT filepath FROM download_archive WHERE archive_key = ?', (key,))]
+            missing = [path for path in paths if not os.path.isfile(path)]
+            if missing:
+                db.executemany('DELETE FROM download_archive WHERE archive_key = ? AND filepath = ?',
+                               [(key, path) for path in missing])
+                db.commit()
+            return [path for path in paths if path not in missing]
+        except sqlite3.Error as e:
+            print(f"Download archive read failed: {e}")
+            return []
+
+def get_library():
+    """Open the library index on first use. Caller must hold library_lock."""
+    global library_db, library_fts
+    if library_db is None:
+        library_db = open_sqlite(LIBRARY_PATH, [
+            '''CREATE TABLE IF NOT EXISTS library (
+                   id INTEGER PRIMARY KEY,
+                   filepath TEXT NOT NULL UNIQUE,
+                   title TEXT,
+                   uploader TEXT,
+                   duration REAL,
+                   format TEXT,
+                   ext TEXT,
+                   size INTEGER,
+                   source_url TEXT,
+                   extractor TEXT,
+                   video_id TEXT,
+                   added_at REAL NOT NULL)''',
+            'CREATE INDEX IF NOT EXISTS library_format ON library (format, id)',
+        ])
+        try:
+            # External-content FTS table kept in sync by triggers, so rows are stored once
+            for statement in (
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS library_fts USING fts5("
+                    "title, uploader, source_url, content='library', content_rowid='id')",
+                    'CREATE TRIGGER IF NOT EXISTS library_ai AFTER INSERT ON library BEGIN '
+                    'INSERT INTO library_fts (rowid, title, uploader, source_url) '
+                    'VALUES (new.id, new.title, new.uploader, new.source_url); END',
+                    'CREATE TRIGGER IF NOT EXISTS library_ad AFTER DELETE ON library BEGIN '
+                    "INSERT INTO library_fts (library_fts, rowid, title, uploader, source_url) "
+                    "VALUES ('delete', old.id, old.title, old.uploader, old.source_url); END",
+                    'CREATE TRIGGER IF NOT EXISTS library_au AFTER UPDATE ON library BEGIN '
+                    "INSERT INTO library_fts (library_fts, rowid, title, uploader, source_url) "
+                    "VALUES ('delete', old.id, old.title, old.uploader, old.source_url); "
+                    'INSERT INTO library_fts (rowid, title, uploader, source_url) '
+                    'VALUES (new.id, new.title, new.uploader, new.source_url); END'):
+                library_db.execute(statement)
+            library_db.commit()
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable, library search falls back to LIKE: {e}")
+            library_fts = False
+    return library_db
+
+def library_metadata(info):
+    """The fields of an info dict that the library index keeps"""
+    return {
+        'title': info.get('title'),
+        'uploader': info.get('uploader') or info.get('channel') or info.get('uploader_id'),
+        'duration': info.get('duration'),
+        'source_url': info.get('webpage_url') or info.get('original_url') or info.get('url'),
+        'extractor': info.get('extractor_key') or info.get('extractor'),
+        'video_id': info.get('id'),
+    }
+
+def library_add(filepath, file_format, metadata):
+    """Index a finished file. Client delivery scratch files are not part of the library."""
+    filepath = os.path.abspath(filepath)
+    if filepath.startswith(os.path.abspath(STREAM_DIR) + os.sep):
+        return
+    try:
+        size = os.path.getsize(filepath)
+    except OSError:
+        return
+    with library_lock:
+        try:
+            db = get_library()
+            db.execute('''INSERT INTO library (filepath, title, uploader, duration, format, ext, size, source_url,
+                                               extractor, video_id, added_at)
+                          VALUES (:filepath, :title, :uploader, :duration, :format, :ext, :size, :source_url,
+                                  :extractor, :video_id, :added_at)
+                          ON CONFLICT (filepath) DO UPDATE SET
+                              title = excluded.title, uploader = excluded.uploader, duration = excluded.duration,
+                              format = excluded.format, ext = excluded.ext, size = excluded.size,
+                              source_url = excluded.source_url, extractor = excluded.extractor,
+                              video_id = excluded.video_id, added_at = excluded.added_at''',
+                       dict(metadata, filepath=filepath, format=file_format, size=size, added_at=time.time(),
+                            ext=os.path.splitext(filepath)[1].lstrip('.')))
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Library index write failed: {e}")
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, as a prefix"""
+    words = [word.replace('"', '') for word in text.split()]
+    return ' '.join(f'"{word}"*' for word in words if word)
+
+def library_search(query='', file_format=None, cursor=None, limit=LIBRARY_PAGE_SIZE):
+    """One page of indexed files, newest first. Keyset pagination on the row id keeps deep pages
+    as cheap as the first one. Rows whose file was deleted are pruned as they are encountered.
+    Returns (items, next cursor or None)."""
+    with library_lock:
+        db = get_library()
+        conditions, params = [], []
+        source, key = 'library', 'library.id'
+        match = fts_query(query) if query else ''
+        if match and library_fts:
+            # Walk the full-text index in rowid order so the cursor and LIMIT apply inside it
+            source, key = 'library_fts JOIN library ON library.id = library_fts.rowid', 'library_fts.rowid'
+            conditions.append('library_fts MATCH ?')
+            params.append(match)
+        elif query and not library_fts:
+            for word in query.split():
+                conditions.append("(title LIKE ? ESCAPE '\\' OR uploader LIKE ? ESCAPE '\\')")
+                pattern = '%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                params.extend([pattern, pattern])
+        if file_format:
+            conditions.append('format = ?')
+            params.append(file_format)
+        if cursor is not None:
+            conditions.append(f'{key} < ?')
+            params.append(cursor)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        db.row_factory = sqlite3.Row
+        try:
+            rows = db.execute(f'SELECT library.* FROM {source}{where} ORDER BY {key} DESC LIMIT ?',
+                              params + [limit + 1]).fetchall()
+        finally:
+            db.row_factory = None
+        next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+        rows = rows[:limit]
+        missing = [row['id'] for row in rows if not os.path.isfile(row['filepath'])]
+        if missing:
+            db.executemany('DELETE FROM library WHERE id = ?', [(row_id,) for row_id in missing])
+            db.commit()
+    return [dict(row) for row in rows if row['id'] not in missing], next_cursor
+
+def reuse_archived_download(info, file_format, download_dir):
+    """Satisfy a download from the archive: skip it if the file is already in download_dir,
+    otherwise hard-link (or copy, across filesystems) an existing file there.
+    Returns the path of the file in download_dir, or None if the download is still needed."""
+    key = archive_key(info, file_format)
+    if key is None:
+        return None
+    paths = archive_lookup(key)
+    if not paths:
+        return None
+
+    target_dir = os.path.realpath(download_dir)
+    for path in paths:
+        if os.path.dirname(os.path.realpath(path)) == target_dir:
+            return path
+
+    # A file of the same name may be a different video with the same title: only reuse it if it is
+    # this file (or a copy of it), otherwise link under a free name
+    for path in paths:
+        target = os.path.join(download_dir, os.path.basename(path))
+        if os.path.exists(target) and same_file(path, target):
+            archive_record(key, target)
+            return target
+    source = paths[0]
+    name, ext = os.path.splitext(os.path.basename(source))
+    for number in itertools.count():
+        target = os.path.join(download_dir, f'{name} ({number}){ext}' if number else name + ext)
+        if os.path.exists(target):
+            if same_file(source, target):
+                break
+            continue
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            continue
+        except OSError:
+            try:
+                shutil.copy2(source, target)
+            except OSError as e:
+                print(f"Could not reuse {source}: {e}")
+                return None
+        break
+    archive_record(key, target)
+    return target
+
+def same_file(path, other):
+    """Whether two paths are the same file, or byte-identical copies"""
+    try:
+        return os.path.samefile(path, other) or filecmp.cmp(path, other, shallow=False)
+    except OSError:
+        return False
+
+class ArchivePP(yt_dlp.postprocessor.PostProcessor):
+    """Records the final file of every download in the download archive and in its job"""
+
+    def __init__(self, download_id, file_format, downloader=None):
+        super().__init__(downloader)
+        self.download_id = download_id
+        self.file_format = file_format
+        self.item = None
+
+    def run(self, info):
+        key = archive_key(info, self.file_format)
+        filepath = info.get('filepath')
+        if filepath and os.path.isfile(filepath):
+            if key:
+                archive_record(key, filepath)
+            library_add(filepath, self.file_format, library_metadata(info))
+            if self.download_id:
+                record_job_file(self.download_id, filepath)
+        return [], info
+
+class Mp3ConvertPP(yt_dlp.postprocessor.PostProcessor):
+    """Hands each downloaded audio file to the post-processing pool instead of converting inline"""
+
+    def __init__(self, download_id, downloader=None):
+        super().__init__(downloader)
+        self.download_id = download_id
+        self.item = None  # (index, title, url) of the playlist item being downloaded
+
+    def run(self, info):
+        filepath = info.get('filepath')
+        if filepath and os.path.isfile(filepath):
+            item = self.item
+            if item and not item[2]:
+                item = (item[0], item[1], info.get('webpage_url') or info.get('original_url'))
+            submit_mp3_conversion(self.download_id, info, filepath, item)
+        return [], info
+
+def submit_mp3_conversion(download_id, info, source, item=None):
+    """Queue an MP3 conversion for a job; the job waits for it in wait_for_postprocessing.
+    `item` identifies the playlist item, so a failed conversion can be reported as a failed item."""
+    key = archive_key(info, 'mp3')
+    with progress_shard(download_id):
+        state = postprocess_jobs.setdefault(download_id, {'futures': [], 'active': {}, 'done': 0, 'waiting': False})
+        state['active'][source] = 0.0
+        future = postprocess_pool.submit(convert_to_mp3, download_id, source, key,
+                                         info.get('duration'), library_metadata(info))
+        state['futures'].append((future, item))
+
+def convert_to_mp3(download_id, source, key, duration=None, metadata=None):
+    """Transcode one file to MP3 with ffmpeg, replacing the source. Runs in the post-processing pool."""
+    target = os.path.splitext(source)[0] + '.mp3'
+    try:
+        if source != target:
+            ffmpeg = shutil.which('ffmpeg')
+            if ffmpeg is None:
+                raise Exception('ffmpeg not found. Please install ffmpeg to convert to MP3.')
+            temp = os.path.splitext(source)[0] + '.temp.mp3'
+            track_partial_file(temp)
+            cmd = [ffmpeg, '-y', '-nostdin', '-loglevel', 'error', '-i', source, '-vn',
+                   '-codec:a', 'libmp3lame', '-b:a', f'{MP3_QUALITY}k', '-progress', 'pipe:1', temp]
+            with timed_phase('postprocessing'):
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                for line in proc.stdout:
+                    # ffmpeg -progress emits key=value lines; out_time_us is the position in the output
+                    if duration and line.startswith('out_time_us=') and line[12:].strip().isdigit():
+                        report_postprocess_progress(download_id, source,
+                                                    min(int(line[12:]) / 1e6 / duration, 1.0))
+                error_output = proc.stderr.read()
+                proc.wait()
+            if proc.returncode != 0:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise Exception(f'ffmpeg failed: {error_output.strip()[-200:]}')
+            os.replace(temp, target)
+            os.remove(source)
+        if key:
+            archive_record(key, target)
+        library_add(target, 'mp3', metadata or {})
+        record_job_file(download_id, target)
+        return target
+    finally:
+        report_postprocess_progress(download_id, source, None)
+
+def report_postprocess_progress(download_id, source, fraction):
+    """Track one conversion's progress (None when it ended) and publish it once the job waits on the stage"""
+    with progress_shard(download_id):
+        state = postprocess_jobs.get(download_id)
+        if state is None:
+            return
+        if fraction is None:
+            state['active'].pop(source, None)
+            state['done'] += 1
+        elif source in state['active']:
+            state['active'][source] = fraction
+        if state['waiting']:
+            publish_postprocess_progress(download_id, state)
+
+def publish_postprocess_progress(download_id, state):
+    """Report the 'postprocessing' phase with its own 0-100 progress. Caller must hold the shard lock."""
+    total = len(state['futures'])
+    done = state['done'] + sum(state['active'].values())
+    update_progress(download_id, 'postprocessing', round(done * 100 / total, 1) if total else 100,
+                    f'Converting to MP3 ({state["done"]}/{total})', state['done'], total)
+
+def wait_for_postprocessing(download_id):
+    """Block until the job's queued conversions finish. Returns (item, error) of failed conversions."""
+    with progress_shard(download_id):
+        state = postprocess_jobs.get(download_id)
+        if state is None:
+            return []
+        state['waiting'] = True
+        publish_postprocess_progress(download_id, state)
+        futures = list(state['futures'])
+    try:
+        wait_futures([future for future, _ in futures])
+    finally:
+        with progress_shard(download_id):
+            postprocess_jobs.pop(download_id, None)
+    return [(item, future.exception()) for future, item in futures if future.exception() is not None]
+
+def download_action(ydl, info, refresh, file_format, download_dir, download_id):
+    """with_retries action running process_download. Info from the extraction cache comes with a `refresh`
+    function: if a download from it fails (e.g. because its signed media URLs expired), the cache entry
+    is dropped and the download is tried once more with freshly extracted info, before the retry policy
+    applies. Later attempts use the fresh info."""
+    state = {'info': info, 'refresh': refresh}
+
+    def attempt():
+        try:
+            return process_download(ydl, state['info'], file_format, download_dir, download_id)
+        except Exception as e:
+            refresh = state['refresh']
+            if refresh is None:
+                raise
+            state['refresh'] = None
+            print(f"Download from cached metadata failed for {download_id}, extracting again: {e}")
+            fresh = refresh()
+            if fresh is None:
+                raise
+            state['info'] = fresh
+            return process_download(ydl, fresh, file_format, download_dir, download_id)
+    return attempt
+
+def process_download(ydl, info, file_format, download_dir, download_id):
+    """Download an extracted video unless the archive already has it. Returns True if reused."""
+    reused = reuse_archived_download(info, file_format, download_dir)
+    if reused:
+        library_add(reused, file_format, library_metadata(info))
+        record_job_file(download_id, reused)
+        return True
+    segments = ydl.params.get('concurrent_fragment_downloads') or 1
+    if segments > 1:
+        # Best effort: on success yt-dlp finds the file in place and only runs post-processing
+        segmented_download(ydl, info, segments)
+    ydl.process_ie_result(info, download=True)
+    return False
+
+def segmented_download(ydl, info, segments):
+    """Fetch a single progressive HTTP format with parallel range requests into its final filename.
+    Returns False (leaving the transfer to yt-dlp) when the format or server doesn't allow it.
+    Progress per range is kept next to the .seg.part file, so a retried or resubmitted job resumes
+    every range where it stopped; transient failures are raised for the retry policy to handle."""
+    if info.get('requested_formats') or info.get('protocol') not in ('http', 'https') or not info.get('url'):
+        return False
+    filename = ydl.prepare_filename(info)
+    if os.path.exists(filename) or os.path.exists(filename + '.part'):
+        return False  # done, or yt-dlp's own partial file from a single-connection attempt: let it resume
+    headers = dict(info.get('http_headers') or {})
+    try:
+        total = probe_range_support(ydl, info['url'], headers)
+    except Exception as e:
+        print(f"Range probe failed, using a single connection: {e}")
+        return False
+    if not total or total < SEGMENT_MIN_SIZE:
+        return False
+
+    temp = filename + '.seg.part'
+    progress_file = filename + '.seg.ytdl'
+    ranges = load_segment_progress(temp, progress_file, total)
+    if ranges is None:
+        segment_size = -(-total // segments)
+        ranges = [[start, min(start + segment_size, total) - 1, 0] for start in range(0, total, segment_size)]
+        with open(temp, 'wb') as f:
+            f.truncate(total)
+    track_partial_file(temp)
+    track_partial_file(progress_file)
+    done = sum(written for _, _, written in ranges)
+    state = {'downloaded': done, 'resumed': done, 'lock': threading.Lock(), 'started': time.time(),
+             'last_report': 0.0, 'last_save': 0.0, 'ranges': ranges, 'progress_file': progress_file}
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix='segment') as pool:
+            futures = [pool.submit(download_segment, ydl, info['url'], headers, temp, index, total, state)
+                       for index, (start, end, written) in enumerate(ranges) if start + written <= end]
+            for future in futures:
+                future.result()
+    except Exception as e:
+        save_segment_progress(state, force=True)
+        if is_transient_error(e):
+            raise
+        print(f"Segmented download failed, falling back to a single connection: {e}")
+        for path in (temp, progress_file):
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+    os.replace(temp, filename)
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+    report_segment_progress(ydl, filename, total, state, 'finished')
+    return True
+
+def load_segment_progress(temp, progress_file, total):
+    """Ranges [start, end, bytes written] of an interrupted segmented transfer of the same size, or None"""
+    try:
+        with open(progress_file) as f:
+            saved = json.load(f)
+        if saved['total'] == total and os.path.getsize(temp) == total:
+            return [[int(start), int(end), int(written)] for start, end, written in saved['ranges']]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_segment_progress(state, force=False):
+    """Write the ranges' progress next to the temp file, at most once a second unless forced"""
+    now = time.time()
+    with state['lock']:
+        if not force and now - state['last_save'] < 1:
+            return
+        state['last_save'] = now
+        saved = {'total': state['ranges'][-1][1] + 1, 'ranges': [list(r) for r in state['ranges']]}
+    try:
+        with open(state['progress_file'] + '.tmp', 'w') as f:
+            json.dump(saved, f)
+        os.replace(state['progress_file'] + '.tmp', state['progress_file'])
+    except OSError as e:
+        print(f"Could not save segment progress: {e}")
+
+def probe_range_support(ydl, url, headers):
+    """Total size of the resource if the server honours byte ranges, else None"""
+    response = ydl.urlopen(yt_dlp.networking.Request(url, headers=dict(headers, Range='bytes=0-0')))
+    try:
+        content_range = response.headers.get('Content-Range', '')
+        if response.status != 206 or '/' not in content_range:
+            return None
+        size = content_range.rsplit('/', 1)[1]
+        return int(size) if size.isdigit() else None
+    finally:
+        response.close()
+
+def download_segment(ydl, url, headers, temp, index, total, state):
+    """Download the rest of range `index` into its place in the preallocated temp file"""
+    segment = state['ranges'][index]
+    start, end = segment[0] + segment[2], segment[1]
+    response = ydl.urlopen(yt_dlp.networking.Request(url, headers=dict(headers, Range=f'bytes={start}-{end}')))
+    try:
+        if response.status != 206:
+            raise Exception(f'server ignored the range request (HTTP {response.status})')
+        with open(temp, 'r+b') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = response.read(min(SEGMENT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise yt_dlp.utils.ContentTooShortError(end - start + 1 - remaining, end - start + 1)
+                f.write(chunk)
+                remaining -= len(chunk)
+                with state['lock']:
+                    segment[2] += len(chunk)
+                    state['downloaded'] += len(chunk)
+                    downloaded = state['downloaded'] - state['resumed']
+                report_segment_progress(ydl, temp, total, state, 'downloading')
+                save_segment_progress(state)
+                # Segments share the job's bandwidth allocation, read live like yt-dlp does
+                rate_limit = ydl.params.get('ratelimit')
+                elapsed = time.time() - state['started']
+                if rate_limit and elapsed > 0 and downloaded / elapsed > rate_limit:
+                    time.sleep(downloaded / rate_limit - elapsed)
+    finally:
+        response.close()
+
+def report_segment_progress(ydl, filename, total, state, status):
+    """Feed aggregate progress over all segments to the YoutubeDL's progress hooks"""
+    now = time.time()
+    if status == 'downloading' and now - state['last_report'] < 0.1:
+        return
+    state['last_report'] = now
+    elapsed = now - state['started']
+    downloaded = state['downloaded']
+    d = {'status': status, 'filename': filename, 'downloaded_bytes': downloaded, 'total_bytes': total,
+         'elapsed': elapsed, 'speed': (downloaded - state['resumed']) / elapsed if elapsed > 0 else None}
+    for hook in ydl.params.get('progress_hooks') or []:
+        hook(d)
+
+def new_youtube_dl(file_format, download_dir, segments):
+    """YoutubeDL instance that records finished files in the download archive.
+    MP3 jobs queue their conversion instead; the archive entry is written once it is done.
+    Per-job state (output directory, progress hook, job ID of the MP3 stage) is attached by YoutubeDLPool.checkout."""
+    job_hook = JobHook()
+    ydl = yt_dlp.YoutubeDL(build_ydl_opts(file_format, download_dir, job_hook, segments))
+    ydl.job_hook = job_hook
+    if file_format == 'mp3':
+        ydl.job_pp = Mp3ConvertPP(None, ydl)
+    else:
+        ydl.job_pp = ArchivePP(None, file_format, ydl)
+    ydl.add_post_processor(ydl.job_pp, when='after_move')
+    return ydl
+
+class JobHook:
+    """Progress hook of a pooled YoutubeDL, forwarding to the job that has it checked out"""
+
+    def __init__(self):
+        self.target = None
+
+    def __call__(self, d):
+        if self.target is not None:
+            self.target(d)
+
+class YoutubeDLPool:
+    """Idle YoutubeDL instances keyed by option profile (format, segments).
+
+    Each checkout gets an instance to itself; on return it goes back to the pool with
+    its extractors, cookie jar and HTTP connections intact. Instances that raised are
+    closed instead, in case the error left them in a bad state.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []  # (profile, ydl), most recently returned last
+        self.stats = {'created': 0, 'reused': 0}
+
+    @contextmanager
+    def checkout(self, file_format, download_dir, segments, download_id, progress_hook, item=None):
+        # The output directory is set per checkout, so jobs writing to different directories
+        # (e.g. client delivery scratch directories) share instances
+        profile = (file_format, segments)
+        ydl = None
+        with self.lock:
+            for index in range(len(self.idle) - 1, -1, -1):
+                if self.idle[index][0] == profile:
+                    ydl = self.idle.pop(index)[1]
+                    self.stats['reused'] += 1
+                    break
+            else:
+                self.stats['created'] += 1
+        if ydl is None:
+            ydl = new_youtube_dl(file_format, download_dir, segments)
+
+        ydl.params['outtmpl']['default'] = output_template(download_dir)
+        ydl.job_hook.target = progress_hook
+        ydl.job_pp.download_id = download_id
+        ydl.job_pp.item = item
+        ydl.params['ratelimit'] = None  # set by the bandwidth allocator while transferring
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        ydl.job_hook.target = None
+        self.release(profile, ydl)
+
+    def release(self, profile, ydl):
+        """Return an instance to the pool, closing the least recently used one if it is full"""
+        with self.lock:
+            self.idle.append((profile, ydl))
+            evicted = self.idle.pop(0)[1] if len(self.idle) > self.size else None
+        if evicted is not None:
+            evicted.close()
+
+def update_progress_hook(d, download_id, item_index=None, live=False):
+    """Progress hook for yt-dlp downloads. With `live`, the file being written can be streamed to the client."""
+    if d['status'] == 'finished':
+        # Once per file, so timing it here costs nothing on the per-chunk path
+        if d.get('elapsed') is not None:
+            phase_latency['transfer'].observe(d['elapsed'])
+    elif d['status'] == 'downloading':
+        track_partial_file(d.get('tmpfilename') or d.get('filename'))
         downloaded = d.get('downloaded_bytes', 0)
-        total = d.get('total_bytes') or d.get('total_bytes_estimate', 1)
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
         percent = (downloaded / total * 100) if total > 0 else 0
+        speed = int(d.get('speed') or 0)
         
-        # Get current progress data to maintain item info
-        current_data = download_progress.get(download_id, {})
-        current_item = current_data.get('current_item', 1)
-        total_items = current_data.get('total_items', 1)
-        item_name = current_data.get('item_name', 'Video')
-        
-        if total_items > 1:
-            # For playlists, adjust progress within the current item's range
-            base_progress = 10 + (current_item - 1) * 80 / total_items
-            item_progress = percent * 0.8 / total_items
-            final_progress = base_progress + item_progress
-            update_progress(download_id, 'downloading_multiple', final_progress,
-                          f'Downloading: {item_name} ({percent:.1f}%)',
-                          current_item, total_items, item_name)
+        now = time.monotonic()
+        
+        if item_index is not None:
+            # Playlist item: cheap lock-free throttle check first, most callbacks stop here
+            state = playlist_progress.get(download_id)
+            item = state['active'].get(item_index) if state is not None else None
+            if item is None or not progress_hook_due(item[2], item[1], percent, now):
+                return
+            # Record this item's share and report the aggregate
+            with progress_shard(download_id):
+                item[1] = min(percent, 100.0)
+                item[2] = now
+                item[3] = speed
+                report_playlist_progress(download_id, f'Downloading: {item[0]} ({percent:.1f}%)')
         else:
-            # Single video
+            # Single video: cheap lock-free throttle check first, most callbacks stop here
+            job = download_progress.get(download_id)
+            if job is None or not progress_hook_due(job.hook_time, job.hook_percent, percent, now):
+                return
+            job.hook_time = now
+            job.hook_percent = percent
+            if live:
+                job.partial_file = d.get('tmpfilename')
+            item_name = job.item_name or 'Video'
             final_progress = 10 + percent * 0.9
             update_progress(download_id, 'downloading', final_progress,
                           f'Downloading: {item_name} ({percent:.1f}%)',
-                          1, 1, item_name)
+                          1, 1, item_name, speed)
 
-@app.route('/')
-def index():
-    cleanup_old_downloads()  # Clean up old downloads on page load
-    html = """<!DOCTYPE html>
+# The UI is a single static page, built and compressed once at startup
+INDEX_HTML = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -356,6 +2303,14 @@ def index():
             margin-top: 5px;
             font-style: italic;
         }
+        
+        label.checkbox-label {
+            display: flex;
+            align-items: center;
+            gap: 10px;
+            font-weight: normal;
+            cursor: pointer;
+        }
             .container {
                 padding: 20px;
                 margin: 10px;
@@ -391,6 +2346,12 @@ def index():
                 <input type="text" id="custom-path" name="custom-path" placeholder="Leave empty for default (./music)">
                 <div class="path-hint">Examples: /Users/username/Downloads, C:\\Downloads, ./my_videos</div>
             </div>
+            <div class="form-group">
+                <label class="checkbox-label">
+                    <input type="checkbox" id="to-device" name="to-device">
+                    💻 Save to this device instead of the server
+                </label>
+            </div>
             <button type="submit" class="download-btn">⬇️ Download</button>
         </form>
     </div>
@@ -413,6 +2374,7 @@ def index():
             const url = document.getElementById('url').value.trim();
             const format = document.getElementById('format').value;
             const customPath = document.getElementById('custom-path').value.trim();
+            const toDevice = document.getElementById('to-device').checked;
             const downloadId = Math.random().toString(36).substr(2, 9) + Date.now().toString(36);
             
             // Show popup
@@ -429,94 +2391,224 @@ def index():
                     url: url, 
                     format: format, 
                     download_id: downloadId,
-                    custom_path: customPath || null
+                    custom_path: customPath || null,
+                    delivery: toDevice ? 'client' : 'server'
                 })
+            }).then(r => {
+                if (!r.ok) {
+                    return r.json().then(body => { throw new Error(body.message || 'Request failed'); });
+                }
             }).catch(err => {
                 console.error('Download request failed:', err);
-                document.getElementById('progress-text').textContent = 'Failed to start download';
+                document.getElementById('progress-text').textContent = 'Failed to start download: ' + err.message;
                 document.getElementById('progress-text').className = 'error';
                 setTimeout(() => document.getElementById('popup').style.display = 'none', 3000);
+                stopTracking();
             });
 
             let finished = false;
-            const interval = setInterval(() => {
-                fetch('/progress?download_id=' + downloadId)
-                .then(r => r.json())
-                .then(data => {
-                    const progressBar = document.getElementById('progress-bar');
-                    const progressText = document.getElementById('progress-text');
-                    const progressDetails = document.getElementById('progress-details');
-                    
-                    progressBar.value = data.progress || 0;
-                    
-                    if (data.status === 'starting') {
-                        progressText.textContent = 'Initializing...';
-                        progressText.className = '';
-                    } else if (data.status === 'extracting') {
-                        progressText.textContent = 'Extracting video information...';
-                        progressText.className = '';
-                    } else if (data.status === 'downloading') {
-                        progressText.textContent = data.message || 'Downloading...';
-                        progressText.className = '';
+            let interval = null;
+            let source = null;
+
+            function stopTracking() {
+                finished = true;
+                if (source) {
+                    source.close();
+                    source = null;
+                }
+                if (interval) {
+                    clearInterval(interval);
+                    interval = null;
+                }
+            }
+
+            function showProgress(data) {
+                const progressBar = document.getElementById('progress-bar');
+                const progressText = document.getElementById('progress-text');
+                const progressDetails = document.getElementById('progress-details');
+                
+                progressBar.value = data.progress || 0;
+                
+                if (data.status === 'queued') {
+                    progressText.textContent = data.queue_position
+                        ? `Queued (position ${data.queue_position})...`
+                        : 'Queued...';
+                    progressText.className = '';
+                } else if (data.status === 'starting') {
+                    progressText.textContent = 'Initializing...';
+                    progressText.className = '';
+                } else if (data.status === 'extracting') {
+                    progressText.textContent = 'Extracting video information...';
+                    progressText.className = '';
+                } else if (data.status === 'downloading') {
+                    progressText.textContent = data.message || 'Downloading...';
+                    progressText.className = '';
+                    progressDetails.textContent = `Progress: ${Math.round(data.progress)}%`;
+                } else if (data.status === 'downloading_multiple') {
+                    progressText.textContent = data.message || 'Downloading playlist...';
+                    progressText.className = '';
+                    if (data.total_items > 1) {
+                        progressDetails.textContent = `Item ${data.current_item} of ${data.total_items} • ${Math.round(data.progress)}%`;
+                    } else {
                         progressDetails.textContent = `Progress: ${Math.round(data.progress)}%`;
-                    } else if (data.status === 'downloading_multiple') {
-                        progressText.textContent = data.message || 'Downloading playlist...';
-                        progressText.className = '';
-                        if (data.total_items > 1) {
-                            progressDetails.textContent = `Item ${data.current_item} of ${data.total_items} • ${Math.round(data.progress)}%`;
-                        } else {
-                            progressDetails.textContent = `Progress: ${Math.round(data.progress)}%`;
+                    }
+                } else if (data.status === 'postprocessing') {
+                    progressText.textContent = data.message || 'Converting...';
+                    progressText.className = '';
+                    progressDetails.textContent = `Converting: ${Math.round(data.progress)}%`;
+                } else if (data.status === 'finished') {
+                    progressText.textContent = data.message || 'Download completed! ✅';
+                    progressText.className = 'success';
+                    progressDetails.textContent = '100% Complete';
+                    if (!finished) {
+                        stopTracking();
+                        if (toDevice) {
+                            for (let index = 0; index < (data.files_count || 0); index++) {
+                                const link = document.createElement('a');
+                                link.href = '/download/file?download_id=' + encodeURIComponent(downloadId) + '&index=' + index;
+                                link.download = '';
+                                document.body.appendChild(link);
+                                link.click();
+                                link.remove();
+                            }
                         }
-                    } else if (data.status === 'finished') {
-                        progressText.textContent = data.message || 'Download completed! ✅';
-                        progressText.className = 'success';
-                        progressDetails.textContent = '100% Complete';
+                        setTimeout(() => {
+                            document.getElementById('popup').style.display = 'none';
+                            document.getElementById('url').value = '';
+                        }, 3000);
+                    }
+                } else if (data.status === 'error') {
+                    progressText.textContent = 'Error: ' + (data.message || 'Unknown error occurred');
+                    progressText.className = 'error';
+                    progressDetails.textContent = '';
+                    setTimeout(() => document.getElementById('popup').style.display = 'none', 4000);
+                    stopTracking();
+                }
+            }
+
+            function startPolling() {
+                interval = setInterval(() => {
+                    fetch('/progress?download_id=' + encodeURIComponent(downloadId))
+                    .then(r => r.json())
+                    .then(showProgress)
+                    .catch(err => {
+                        console.error('Progress check failed:', err);
                         if (!finished) {
-                            finished = true;
-                            setTimeout(() => {
-                                document.getElementById('popup').style.display = 'none';
-                                document.getElementById('url').value = '';
-                            }, 3000);
-                            clearInterval(interval);
+                            document.getElementById('progress-text').textContent = 'Connection error';
+                            document.getElementById('progress-text').className = 'error';
+                            setTimeout(() => document.getElementById('popup').style.display = 'none', 3000);
+                            stopTracking();
                         }
-                    } else if (data.status === 'error') {
-                        progressText.textContent = 'Error: ' + (data.message || 'Unknown error occurred');
-                        progressText.className = 'error';
-                        progressDetails.textContent = '';
-                        setTimeout(() => document.getElementById('popup').style.display = 'none', 4000);
-                        clearInterval(interval);
+                    });
+                }, 500); // Check more frequently for smoother updates
+            }
+
+            // Prefer pushed updates; fall back to polling if the stream is unavailable
+            if (window.EventSource) {
+                source = new EventSource('/progress/stream?download_id=' + encodeURIComponent(downloadId));
+                source.onmessage = e => showProgress(JSON.parse(e.data));
+                source.onerror = () => {
+                    if (source) {
+                        source.close();
+                        source = null;
                     }
-                })
-                .catch(err => {
-                    console.error('Progress check failed:', err);
-                    if (!finished) {
-                        document.getElementById('progress-text').textContent = 'Connection error';
-                        document.getElementById('progress-text').className = 'error';
-                        setTimeout(() => document.getElementById('popup').style.display = 'none', 3000);
-                        clearInterval(interval);
+                    if (!finished && !interval) {
+                        startPolling();
                     }
-                });
-            }, 500); // Check more frequently for smoother updates
+                };
+            } else {
+                startPolling();
+            }
         };
     </script>
 </body>
 </html>
 """
-    return Response(html, mimetype='text/html')
 
-@app.route('/download', methods=['POST'])
-def download():
-    data = request.get_json()
-    url = data.get('url', '').strip()
-    format_ = data.get('format', 'mp4')
-    download_id = data.get('download_id')
-    custom_path = data.get('custom_path', '').strip()
+def build_static_asset(body, mimetype):
+    """Precompute the encoded variants and ETag of a static response"""
+    data = body.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    variants = {'identity': data, 'gzip': gzip.compress(data, compresslevel=9)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data)
+    return {'mimetype': mimetype, 'digest': digest, 'variants': variants}
+
+def serve_static_asset(asset):
+    """Serve a precomputed asset, honouring Accept-Encoding and If-None-Match"""
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in asset['variants'] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    # Strong ETags must differ between encoded representations
+    etag = f"{asset['digest']}-{encoding}"
     
-    if not url:
-        return jsonify({'status': 'error', 'message': 'No URL provided'}), 400
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset['variants'][encoding], mimetype=asset['mimetype'])
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate; unchanged pages cost a 304
+    response.vary.add('Accept-Encoding')
+    return response
+
+index_asset = build_static_asset(INDEX_HTML, 'text/html')
+
+@app.route('/')
+def index():
+    return serve_static_asset(index_asset)
+
+@app.route('/healthz')
+def healthz():
+    """Liveness check that does no work, for container health checks"""
+    return 'ok', 200, {'Content-Type': 'text/plain', 'Cache-Control': 'no-store'}
+
+def parse_job_options(data):
+    """Validate the download options shared by single and batch submissions.
+    Returns (options, priority, error message)."""
+    format_ = data.get('format') or 'mp4'
+    custom_path = (data.get('custom_path') or '').strip()
     
-    if not download_id:
-        download_id = str(uuid.uuid4())
+    try:
+        priority = int(data.get('priority') or 0)
+    except (TypeError, ValueError):
+        return None, None, 'Invalid priority'
+    
+    segments = data.get('segments')
+    if segments is not None:
+        try:
+            segments = int(segments)
+        except (TypeError, ValueError):
+            return None, None, 'Invalid segments'
+        if not 1 <= segments <= MAX_DOWNLOAD_SEGMENTS:
+            return None, None, f'segments must be between 1 and {MAX_DOWNLOAD_SEGMENTS}'
+    
+    playlist_concurrency = data.get('playlist_concurrency')
+    if playlist_concurrency is not None:
+        try:
+            playlist_concurrency = int(playlist_concurrency)
+        except (TypeError, ValueError):
+            return None, None, 'Invalid playlist_concurrency'
+        if not 1 <= playlist_concurrency <= MAX_PLAYLIST_CONCURRENCY:
+            return None, None, f'playlist_concurrency must be between 1 and {MAX_PLAYLIST_CONCURRENCY}'
+    
+    rate_limit = data.get('rate_limit')
+    if rate_limit not in (None, ''):
+        try:
+            rate_limit = yt_dlp.utils.parse_bytes(str(rate_limit))
+        except Exception:
+            rate_limit = None
+        if not rate_limit or rate_limit <= 0:
+            return None, None, 'Invalid rate_limit (bytes/sec, e.g. 500K or 2M)'
+    else:
+        rate_limit = None
+    
+    delivery = data.get('delivery') or 'server'
+    if delivery not in ('server', 'client'):
+        return None, None, "delivery must be 'server' or 'client'"
     
     # Validate custom path if provided
     if custom_path:
@@ -528,19 +2620,130 @@ def download():
         try:
             normalized_path = os.path.normpath(custom_path)
             if '..' in normalized_path.split(os.sep):
-                return jsonify({'status': 'error', 'message': 'Invalid path: directory traversal not allowed'}), 400
+                return None, None, 'Invalid path: directory traversal not allowed'
         except Exception:
-            return jsonify({'status': 'error', 'message': 'Invalid path format'}), 400
+            return None, None, 'Invalid path format'
     
-    # Initialize progress tracking
-    update_progress(download_id, 'starting', 0, 'Starting download...')
+    options = {'file_format': format_, 'custom_path': custom_path,
+               'playlist_concurrency': playlist_concurrency, 'rate_limit': rate_limit,
+               'segments': segments, 'delivery': delivery}
+    return options, priority, None
+
+@app.route('/download', methods=['POST'])
+def download():
+    data = request.get_json()
+    url = (data.get('url') or '').strip()
+    download_id = data.get('download_id')
     
-    # Start download in background thread
-    thread = threading.Thread(target=download_file, args=(url, format_, download_id, custom_path))
-    thread.daemon = True
-    thread.start()
+    if not url:
+        return jsonify({'status': 'error', 'message': 'No URL provided'}), 400
     
-    return jsonify({'status': 'started', 'download_id': download_id})
+    if not download_id:
+        download_id = str(uuid.uuid4())
+    elif not isinstance(download_id, str) or not JOB_ID_PATTERN.fullmatch(download_id):
+        return jsonify({'status': 'error',
+                        'message': 'Invalid download_id (1-64 letters, digits, "-" or "_")'}), 400
+    
+    options, priority, error = parse_job_options(data)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
+    
+    # Record the job and initialize progress tracking
+    job = dict(options, url=url)
+    job_store.add_job(download_id, job, priority)
+    update_progress(download_id, 'queued', 0, 'Waiting in queue...')
+    
+    # Hand the job to the worker pool (lower priority value runs first)
+    if not enqueue_download(download_id, job, priority):
+        forget_jobs([download_id])
+        return jsonify({'status': 'error', 'message': 'Download queue is full, please retry later'}), 429
+    
+    return jsonify({'status': 'queued', 'download_id': download_id,
+                    'queue_position': queue_position(download_id)})
+
+@app.route('/download/batch', methods=['POST'])
+def download_batch():
+    """Queue many URLs sharing the same options.
+    Accepts JSON {"urls": [...], ...options} or a newline-delimited URL list
+    (text/plain body or a 'file' upload) with options in the query string or form."""
+    if request.is_json:
+        data = request.get_json()
+        urls = data.get('urls')
+        if not isinstance(urls, list):
+            return jsonify({'status': 'error', 'message': 'urls must be a list'}), 400
+    else:
+        data = request.form.to_dict() or request.args.to_dict()
+        upload = request.files.get('file')
+        text = upload.read().decode('utf-8', 'replace') if upload else request.get_data(as_text=True)
+        urls = [line for line in text.splitlines() if not line.strip().startswith('#')]
+    
+    urls = [url.strip() for url in urls if isinstance(url, str) and url.strip()]
+    if not urls:
+        return jsonify({'status': 'error', 'message': 'No URLs provided'}), 400
+    if len(urls) > MAX_BATCH_SIZE:
+        return jsonify({'status': 'error', 'message': f'Batch too large (max {MAX_BATCH_SIZE} URLs)'}), 400
+    
+    options, priority, error = parse_job_options(data)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
+    
+    batch_id = data.get('batch_id') or str(uuid.uuid4())
+    if not isinstance(batch_id, str) or not JOB_ID_PATTERN.fullmatch(batch_id):
+        return jsonify({'status': 'error', 'message': 'Invalid batch_id (1-64 letters, digits, "-" or "_")'}), 400
+    jobs = [(f'{batch_id}-{index}', dict(options, url=url)) for index, url in enumerate(urls)]
+    items = [(download_id, job['url']) for download_id, job in jobs]
+    
+    job_store.add_jobs(jobs, priority)
+    for download_id, _ in jobs:
+        update_progress(download_id, 'queued', 0, 'Waiting in queue...')
+    
+    # Whatever fits goes into the worker pool's queue now, the rest follows as workers free up
+    pending = enqueue_batch(jobs, priority)
+    if pending is None:
+        forget_jobs([download_id for download_id, _ in jobs])
+        return jsonify({'status': 'error', 'message': 'Batch backlog is full, please retry later'}), 429
+    
+    with download_lock:
+        download_batches[batch_id] = {'created_at': time.time(), 'items': items, 'pending': pending}
+    job_store.add_batch(batch_id, items)
+    
+    return jsonify({'status': 'queued', 'batch_id': batch_id,
+                    'items': [{'url': url, 'download_id': download_id} for download_id, url in items]})
+
+@app.route('/batch/progress')
+def batch_progress():
+    """Aggregate progress of a batch plus a compact per-item status list"""
+    batch_id = request.args.get('batch_id')
+    if not batch_id:
+        return jsonify({'status': 'error', 'message': 'No batch ID provided'}), 400
+    
+    with download_lock:
+        batch = download_batches.get(batch_id)
+    items = batch['items'] if batch else job_store.load_batch(batch_id)
+    if not items:
+        return jsonify({'status': 'unknown', 'message': 'Batch not found'}), 404
+    
+    counts = defaultdict(int)
+    total_progress = 0
+    item_states = []
+    for download_id, url in items:
+        data = get_progress(download_id) or {'status': 'unknown', 'progress': 0}
+        counts[data['status']] += 1
+        total_progress += data.get('progress', 0)
+        item_states.append({'download_id': download_id, 'url': url, 'status': data['status'],
+                            'progress': data.get('progress', 0), 'message': data.get('message', '')})
+    
+    finished, failed = counts.get('finished', 0), counts.get('error', 0)
+    return jsonify({
+        'batch_id': batch_id,
+        'status': 'finished' if finished + failed == len(items) else 'running',
+        'progress': total_progress / len(items),
+        'total_items': len(items),
+        'completed_items': finished,
+        'failed_items': failed,
+        'counts': dict(counts),
+        'items': item_states,
+    })
 
 @app.route('/progress')
 def progress():
@@ -548,20 +2751,405 @@ def progress():
     if not download_id:
         return jsonify({'status': 'error', 'message': 'No download ID provided'}), 400
     
-    with download_lock:
-        progress_data = download_progress.get(download_id, {
-            'status': 'unknown', 
-            'progress': 0, 
-            'message': 'Download not found'
-        })
+    # Long-poll: with ?since=<version> wait until the job has a newer version
+    try:
+        since = request.args.get('since', type=int)
+        timeout = min(float(request.args.get('timeout', 25)), PROGRESS_LONG_POLL_MAX)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid since or timeout'}), 400
+    
+    progress_data = get_progress(download_id, since, timeout) or {
+        'status': 'unknown', 
+        'progress': 0, 
+        'message': 'Download not found'
+    }
     
     return jsonify(progress_data)
 
+def new_stream_state(last_version=0):
+    """Per-connection state of a progress stream"""
+    return {'version': last_version, 'queue_pos': None, 'started': time.time(), 'wait': PROGRESS_STREAM_HEARTBEAT}
+
+def progress_stream_event(data, state):
+    """Next SSE chunk for a progress snapshot, shared by the WSGI and ASGI streams. Returns (text, done)."""
+    if data is None:
+        # The job is registered by POST /download, which may still be in flight
+        if time.time() - state['started'] > PROGRESS_LONG_POLL_MAX:
+            return 'data: ' + json.dumps({'status': 'unknown', 'progress': 0,
+                                          'message': 'Download not found'}) + '\n\n', True
+        return ': keep-alive\n\n', False
+    # Queue positions move without a version bump, so re-check them more often
+    state['wait'] = 2 if data['status'] == 'queued' else PROGRESS_STREAM_HEARTBEAT
+    if data['version'] <= state['version'] and data.get('queue_position') == state['queue_pos']:
+        return ': keep-alive\n\n', False
+    state['version'], state['queue_pos'] = data['version'], data.get('queue_position')
+    return f"id: {state['version']}\ndata: {json.dumps(data)}\n\n", data['status'] in ('finished', 'error')
+
+@app.route('/progress/stream')
+def progress_stream():
+    """Server-Sent Events stream pushing a job's progress whenever it changes"""
+    download_id = request.args.get('download_id')
+    if not download_id:
+        return jsonify({'status': 'error', 'message': 'No download ID provided'}), 400
+    
+    try:
+        last_version = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_version = 0
+    
+    def events():
+        state = new_stream_state(last_version)
+        yield 'retry: 2000\n\n'
+        while True:
+            data = get_progress(download_id, state['version'], state['wait'])
+            text, done = progress_stream_event(data, state)
+            yield text
+            if done:
+                return
+    
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/download/file')
+def download_result():
+    """Send a job's output file to the client. Finished files support Range requests; a single-format
+    download that is still running is streamed as it is written. Without an index, list the job's files."""
+    download_id = request.args.get('download_id')
+    if not download_id:
+        return jsonify({'status': 'error', 'message': 'No download ID provided'}), 400
+    index = request.args.get('index')
+    if index is not None:
+        try:
+            index = int(index)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Invalid index'}), 400
+    
+    data = get_progress(download_id)
+    files = get_job_files(download_id)
+    if data is None or files is None:
+        return jsonify({'status': 'unknown', 'message': 'Download not found'}), 404
+    if index is None:
+        return jsonify({'status': data['status'],
+                        'files': [{'index': i, 'name': os.path.basename(path)} for i, path in enumerate(files)]})
+    if 0 <= index < len(files):
+        if not os.path.isfile(files[index]):
+            return jsonify({'status': 'error', 'message': 'File is no longer available'}), 410
+        # conditional=True answers Range and If-None-Match; the server may use sendfile for the body
+        return flask.send_file(files[index], as_attachment=True, download_name=os.path.basename(files[index]),
+                               conditional=True, max_age=0)
+    
+    if index == 0 and data['status'] not in ('finished', 'error'):
+        response = stream_partial_file(download_id)
+        if response is not None:
+            return response
+    if data['status'] == 'error':
+        return jsonify({'status': 'error', 'message': data['message']}), 409
+    if data['status'] == 'finished':
+        return jsonify({'status': 'error', 'message': 'No such file'}), 404
+    return jsonify({'status': data['status'], 'message': 'File is not available yet'}), 409
+
+def open_partial_file(download_id):
+    """Open the file a running single-format job is writing, for following it.
+    Returns (file, response headers), or (None, None) if nothing can be streamed yet."""
+    with progress_shard(download_id):
+        job = download_progress.get(download_id)
+        partial = job.partial_file if job is not None else None
+    if not partial:
+        return None, None
+    try:
+        f = open(partial, 'rb')  # keeps reading the same file after yt-dlp renames it on completion
+    except OSError:
+        return None, None
+    name = os.path.basename(partial)
+    if name.endswith('.part'):
+        name = name[:-5]
+    headers = {'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+               'Content-Disposition': f"attachment; filename*=UTF-8''{quote(name)}", 'Cache-Control': 'no-cache',
+               'X-Accel-Buffering': 'no'}
+    return f, headers
+
+def partial_file_complete(download_id, data):
+    """Called once a follower has read everything written so far: True if the file is complete and the
+    rest can be read to the end, False if more is coming"""
+    if data is None or data['status'] == 'error':
+        # Drop the connection rather than ending the body, so the client sees a failed transfer
+        raise Exception(f'Download {download_id} failed while streaming')
+    return data['status'] in ('finished', 'postprocessing') or bool(data.get('files_count'))
+
+def stream_partial_file(download_id):
+    """Chunked response following a file while yt-dlp writes it, or None if nothing can be streamed yet"""
+    f, headers = open_partial_file(download_id)
+    if f is None:
+        return None
+    
+    def follow():
+        version = 0
+        with f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                    continue
+                data = get_progress(download_id, version, PROGRESS_STREAM_HEARTBEAT)
+                if partial_file_complete(download_id, data):
+                    while True:
+                        chunk = f.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            return
+                        yield chunk
+                version = data['version']
+    
+    return Response(follow(), headers=headers)
+
+@app.route('/library')
+def library():
+    """Search the index of downloaded files"""
+    query = (request.args.get('q') or '').strip()
+    file_format = request.args.get('format') or None
+    try:
+        cursor = int(request.args['cursor']) if request.args.get('cursor') else None
+        limit = int(request.args.get('limit') or LIBRARY_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'cursor and limit must be integers'}), 400
+    if not 1 <= limit <= LIBRARY_MAX_PAGE_SIZE:
+        return jsonify({'status': 'error', 'message': f'limit must be between 1 and {LIBRARY_MAX_PAGE_SIZE}'}), 400
+    
+    try:
+        items, next_cursor = library_search(query, file_format, cursor, limit)
+    except sqlite3.Error as e:
+        print(f"Library search failed: {e}")
+        return jsonify({'status': 'error', 'message': 'Library search failed'}), 500
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/cache/stats')
+def cache_stats():
+    with extraction_cache_lock:
+        stats = dict(extraction_cache_stats)
+        try:
+            stats['entries'] = get_extraction_cache().execute('SELECT COUNT(*) FROM extraction_cache').fetchone()[0]
+        except (sqlite3.Error, OSError):
+            stats['entries'] = None
+    stats['ttl'] = EXTRACTION_CACHE_TTL
+    stats['max_entries'] = EXTRACTION_CACHE_MAX_ENTRIES
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of scheduler, transfer and per-phase metrics"""
+    with job_queue_cond:
+        queue_depth = len(job_queue)
+        active = len(active_jobs)
+    with download_lock:
+        jobs = list(download_progress.values())
+    throughput = sum(job.speed for job in jobs)  # plain reads, a slightly stale sum is fine
+    with metrics_lock:
+        results = dict(job_results)
+        failures = dict(item_failures)
+    with extraction_cache_lock:
+        cache = dict(extraction_cache_stats)
+    
+    lines = []
+    
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+    
+    metric('video_downloader_queue_depth', 'gauge', 'Jobs waiting for a worker', [('', queue_depth)])
+    metric('video_downloader_active_jobs', 'gauge', 'Jobs currently running', [('', active)])
+    metric('video_downloader_workers', 'gauge', 'Size of the download worker pool', [('', MAX_CONCURRENT_DOWNLOADS)])
+    metric('video_downloader_worker_utilization', 'gauge', 'Fraction of workers busy',
+           [('', active / MAX_CONCURRENT_DOWNLOADS)])
+    metric('video_downloader_tracked_jobs', 'gauge', 'Jobs with progress records in memory', [('', len(jobs))])
+    metric('video_downloader_download_bytes_per_second', 'gauge', 'Current aggregate download throughput',
+           [('', throughput)])
+    metric('video_downloader_jobs_total', 'counter', 'Finished jobs by outcome and error class',
+           [(f'status="{status}",error_class="{error}"', count) for (status, error), count in sorted(results.items())])
+    metric('video_downloader_playlist_item_failures_total', 'counter', 'Failed playlist items by error class',
+           [(f'error_class="{error}"', count) for error, count in sorted(failures.items())])
+    metric('video_downloader_extraction_cache_total', 'counter', 'Extraction cache lookups and evictions',
+           [(f'result="{result}"', count) for result, count in sorted(cache.items())])
+    with ydl_pool.lock:
+        pool_stats = dict(ydl_pool.stats)
+        pool_idle = len(ydl_pool.idle)
+    metric('video_downloader_ydl_pool_checkouts_total', 'counter', 'YoutubeDL checkouts by whether an idle instance was reused',
+           [(f'result="{result}"', count) for result, count in sorted(pool_stats.items())])
+    metric('video_downloader_ydl_pool_idle', 'gauge', 'Idle pooled YoutubeDL instances', [('', pool_idle)])
+    
+    lines.append('# HELP video_downloader_phase_seconds Latency of download phases')
+    lines.append('# TYPE video_downloader_phase_seconds histogram')
+    for phase in PHASES:
+        lines.extend(phase_latency[phase].render('video_downloader_phase_seconds', f'phase="{phase}"'))
+    
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 @app.route('/log', methods=['POST'])
 def log():
     data = flask.request.json
     print('JS Console:', data.get('message'))
     return '', 204
 
+class ProgressStreamASGI:
+    """ASGI front end for production serving.
+
+    Requests that wait on a job run as coroutines on the event loop, so thousands of
+    idle connections don't each hold an OS thread: progress streams, long-polls of
+    /progress?since=... and live follows of /download/file. /healthz is answered here
+    too, so health checks never queue behind busy threads. Every other request is
+    handed to the Flask app on a bounded thread pool.
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            path = scope['path']
+            query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+            if path == '/healthz':
+                await send({'type': 'http.response.start', 'status': 200,
+                            'headers': [(b'content-type', b'text/plain'), (b'cache-control', b'no-store')]})
+                await send({'type': 'http.response.body', 'body': b'ok'})
+                return
+            if path == '/progress/stream':
+                await self.progress_stream(scope, receive, send, query)
+                return
+            if path == '/progress' and query.get('download_id') and query.get('since', '').lstrip('-').isdigit():
+                await self.progress_long_poll(send, query)
+                return
+            if path == '/download/file' and await self.follow_partial_file(receive, send, query):
+                return
+        await self.wsgi(scope, receive, send)
+
+    async def send_json(self, send, status, data):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': json.dumps(data).encode()})
+
+    def watch_disconnect(self, receive):
+        """Event set once the client has gone away, and the task setting it"""
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        return disconnected, asyncio.ensure_future(watch())
+
+    async def progress_long_poll(self, send, query):
+        """/progress?since=<version>: same answer as the Flask route, waiting on the event loop"""
+        try:
+            timeout = min(float(query.get('timeout', 25)), PROGRESS_LONG_POLL_MAX)
+        except ValueError:
+            await self.send_json(send, 400, {'status': 'error', 'message': 'Invalid since or timeout'})
+            return
+        data = await get_progress_async(query['download_id'], int(query['since']), timeout)
+        await self.send_json(send, 200, data or {'status': 'unknown', 'progress': 0, 'message': 'Download not found'})
+
+    async def follow_partial_file(self, receive, send, query):
+        """Live follow of /download/file. Returns False if the request isn't one, for the Flask route to answer."""
+        download_id = query.get('download_id')
+        if not download_id or query.get('index') != '0':
+            return False
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, get_progress, download_id)
+        if data is None or data['status'] in ('finished', 'error') or data.get('files_count'):
+            return False
+        f, headers = open_partial_file(download_id)
+        if f is None:
+            return False
+
+        disconnected, watcher = self.watch_disconnect(receive)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                                for key, value in headers.items()]})
+        try:
+            version = 0
+            complete = False
+            while not disconnected.is_set():
+                chunk = await loop.run_in_executor(None, f.read, STREAM_CHUNK_SIZE)
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    continue
+                if complete:
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+                data = await get_progress_async(download_id, version, PROGRESS_STREAM_HEARTBEAT)
+                complete = partial_file_complete(download_id, data)
+                version = data['version']
+        finally:
+            watcher.cancel()
+            f.close()
+        return True
+
+    async def progress_stream(self, scope, receive, send, query):
+        headers = dict(scope.get('headers') or [])
+        download_id = query.get('download_id')
+        if not download_id:
+            await self.send_json(send, 400, {'status': 'error', 'message': 'No download ID provided'})
+            return
+        try:
+            last_version = int(headers.get(b'last-event-id', b'0'))
+        except ValueError:
+            last_version = 0
+
+        disconnected, watcher = self.watch_disconnect(receive)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        try:
+            await send({'type': 'http.response.body', 'body': b'retry: 2000\n\n', 'more_body': True})
+            state = new_stream_state(last_version)
+            while not disconnected.is_set():
+                data = await get_progress_async(download_id, state['version'], state['wait'])
+                text, done = progress_stream_event(data, state)
+                await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': not done})
+                if done:
+                    return
+        finally:
+            watcher.cancel()
+
+asgi_app = ProgressStreamASGI(app, WEB_THREADS) if uvicorn is not None else None
+
+def serve(argv):
+    """Production entry point: `python app.py serve [--host H] [--port P] [--workers N]`"""
+    parser = argparse.ArgumentParser(prog='app.py serve', description='Run the video downloader with uvicorn')
+    parser.add_argument('--host', default=FLASK_HOST)
+    parser.add_argument('--port', type=int, default=FLASK_PORT)
+    parser.add_argument('--workers', type=int, default=WEB_WORKERS, help='server processes')
+    args = parser.parse_args(argv)
+    
+    if uvicorn is None:
+        print('uvicorn is not installed; install it with `pip install uvicorn` to use `serve`')
+        sys.exit(1)
+    if args.workers > 1 and not job_store.shared:
+        print('Warning: several workers without JOB_STORE=sqlite do not share job progress')
+    
+    if args.workers == 1:
+        start_background_services()
+        uvicorn.run(asgi_app, host=args.host, port=args.port, lifespan='off')
+    else:
+        # Each worker process imports this module and starts its own background services
+        uvicorn.run('app:asgi_app', host=args.host, port=args.port, workers=args.workers, lifespan='off',
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+
+def start_background_services():
+    """Start the job store heartbeat and the janitor for this process"""
+    start_job_store_maintenance()
+    start_janitor()
+
+bandwidth = BandwidthAllocator(GLOBAL_RATE_LIMIT)
+ydl_pool = YoutubeDLPool(YDL_POOL_SIZE)
+job_store = create_job_store()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=2070, debug=False)
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2:])
+    else:
+        start_background_services()
+        app.run(host=FLASK_HOST, port=FLASK_PORT, debug=False, threaded=True)
+else:
+    # Imported by a WSGI/ASGI server
+    start_background_services()
@@ -0,0 +1,360 @@
+"""Benchmark suite for app.py.
+
+Runs the app in-process against a local fake media server (no network) and writes the
+results as JSON, so runs on different commits can be compared:
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --output after.json
+    python benchmarks/bench.py --compare before.json after.json
+
+Benchmarks:
+    jobs             jobs/sec and end-to-end latency of single-video downloads, plus one playlist
+    progress_polling /progress requests/sec and latency with N concurrent pollers
+    update_progress  update_progress calls/sec from several threads, on distinct jobs and on one shared job
+    memory           memory held per job in download_progress, before and after expiry
+
+Jobs are driven through the HTTP API only, and app internals are feature-detected, so the suite
+also runs against older commits. A benchmark whose hooks an older app lacks is reported as skipped.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_media_server import FakeMediaServer  # noqa: E402
+
+BENCHMARKS = ('jobs', 'progress_polling', 'update_progress', 'memory')
+# App functions each benchmark calls directly; the jobs benchmark only uses the HTTP API
+REQUIRED_HOOKS = {
+    'progress_polling': ('update_progress',),
+    'update_progress': ('update_progress',),
+    'memory': ('update_progress',),
+}
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(values):
+    return {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99),
+            'max': max(values) if values else None}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_app(config_dir, args):
+    """Import app.py with an isolated config directory and limits sized for the benchmark"""
+    os.environ['CONFIG_DIR'] = config_dir
+    os.environ['JOB_STORE'] = 'memory'
+    os.environ['MAX_QUEUE_SIZE'] = str(max(100, args.jobs * 2))
+    os.environ['MAX_TRACKED_JOBS'] = str(max(10000, args.memory_jobs * 2))
+    os.environ['MAX_CONCURRENT_DOWNLOADS'] = str(args.workers)
+    import app
+    return app
+
+
+def forget_jobs(app, download_ids):
+    """Drop benchmark jobs from the app, with forget_jobs where it exists"""
+    if hasattr(app, 'forget_jobs'):
+        app.forget_jobs(list(download_ids))
+        return
+    with app.download_lock:
+        for download_id in download_ids:
+            app.download_progress.pop(download_id, None)
+
+
+def expire_all_jobs(app):
+    """Run the app's expiry as if every job had outlived its TTL. Returns the number of jobs dropped, or None
+    if the app has no expiry to run."""
+    before = len(app.download_progress)
+    if hasattr(app, 'expire_jobs'):
+        app.expire_jobs(time.time() + max(app.JOB_TTL_FINISHED, app.JOB_TTL_ERROR) + 1)
+    elif hasattr(app, 'cleanup_old_downloads'):
+        # Older apps drop jobs created more than an hour ago
+        later = time.time() + 3601
+        with mock.patch.object(app.time, 'time', return_value=later):
+            app.cleanup_old_downloads()
+    else:
+        return None
+    return before - len(app.download_progress)
+
+
+def wait_for_jobs(client, download_ids, timeout):
+    """Poll /progress until every job has ended. Returns {download_id: (status, end time)}."""
+    pending = set(download_ids)
+    ended = {}
+    deadline = time.perf_counter() + timeout
+    while pending and time.perf_counter() < deadline:
+        for download_id in list(pending):
+            data = client.get(f'/progress?download_id={download_id}').get_json()
+            if data is not None and data.get('status') in ('finished', 'error'):
+                ended[download_id] = (data['status'], time.perf_counter())
+                pending.discard(download_id)
+        time.sleep(0.005)
+    return ended
+
+
+def bench_jobs(app, server, download_dir, args):
+    """Throughput and end-to-end latency of downloads through the HTTP API"""
+    client = app.app.test_client()
+    run = int(time.time() * 1000)
+    submitted = {}
+    started = time.perf_counter()
+    for i in range(args.jobs):
+        url = server.media_url(f'job-{run}-{i}', args.media_size)
+        response = client.post('/download', json={'url': url, 'format': 'mp4', 'custom_path': download_dir})
+        submitted[response.get_json()['download_id']] = time.perf_counter()
+    ended = wait_for_jobs(client, submitted, args.timeout)
+    wall = time.perf_counter() - started
+
+    latencies = [end - submitted[download_id] for download_id, (status, end) in ended.items()]
+    result = {
+        'jobs': args.jobs,
+        'media_size': args.media_size,
+        'workers': args.workers,
+        'finished': sum(1 for status, _ in ended.values() if status == 'finished'),
+        'errors': sum(1 for status, _ in ended.values() if status == 'error'),
+        'timed_out': args.jobs - len(ended),
+        'wall_seconds': wall,
+        'jobs_per_second': len(ended) / wall if wall > 0 else None,
+        'latency_seconds': latency_summary(latencies),
+    }
+
+    # One playlist, expanded by yt-dlp's generic extractor from <video> tags
+    url = server.playlist_url(f'playlist-{run}', args.playlist_items, args.media_size)
+    started = time.perf_counter()
+    response = client.post('/download', json={'url': url, 'format': 'mp4', 'custom_path': download_dir})
+    download_id = response.get_json()['download_id']
+    ended = wait_for_jobs(client, [download_id], args.timeout)
+    status, end = ended.get(download_id, ('timeout', time.perf_counter()))
+    result['playlist'] = {'items': args.playlist_items, 'status': status, 'seconds': end - started,
+                          'items_per_second': args.playlist_items / (end - started)}
+    return result
+
+
+def bench_progress_polling(app, args):
+    """/progress throughput with concurrent pollers while the job is being updated"""
+    download_id = 'bench-poll'
+    app.update_progress(download_id, 'downloading', 0, 'Downloading: bench')
+    stop = threading.Event()
+
+    def writer():
+        percent = 0
+        while not stop.is_set():
+            percent = (percent + 1) % 100
+            app.update_progress(download_id, 'downloading', percent, f'Downloading: bench ({percent}%)')
+            time.sleep(0.001)
+
+    counts = [0] * args.pollers
+    latencies = [[] for _ in range(args.pollers)]
+
+    def poller(index):
+        client = app.app.test_client()
+        while not stop.is_set():
+            started = time.perf_counter()
+            client.get(f'/progress?download_id={download_id}')
+            latencies[index].append(time.perf_counter() - started)
+            counts[index] += 1
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=poller, args=(i,))
+                                                   for i in range(args.pollers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    forget_jobs(app, [download_id])
+    return {'pollers': args.pollers, 'requests': sum(counts), 'requests_per_second': sum(counts) / wall,
+            'latency_seconds': latency_summary([value for values in latencies for value in values])}
+
+
+def bench_update_progress(app, args):
+    """Calls/sec of update_progress from one thread and from several, on distinct jobs and one shared job.
+    The shared job scaling much worse than distinct jobs points to contention on its shard lock."""
+
+    def run(threads, shared):
+        ids = [f'bench-update-{"shared" if shared else i}' for i in range(threads)]
+        barrier = threading.Barrier(threads + 1)
+
+        def worker(download_id):
+            barrier.wait()
+            for n in range(args.updates):
+                app.update_progress(download_id, 'downloading', n % 100, 'Downloading: bench')
+
+        workers = [threading.Thread(target=worker, args=(download_id,)) for download_id in ids]
+        for worker_thread in workers:
+            worker_thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for worker_thread in workers:
+            worker_thread.join()
+        elapsed = time.perf_counter() - started
+        forget_jobs(app, set(ids))
+        return threads * args.updates / elapsed
+
+    single = run(1, False)
+    distinct = run(args.threads, False)
+    shared = run(args.threads, True)
+    return {
+        'threads': args.threads,
+        'updates_per_thread': args.updates,
+        'single_thread_per_second': single,
+        'distinct_jobs_per_second': distinct,
+        'shared_job_per_second': shared,
+        'distinct_jobs_scaling': distinct / single,
+        'shared_job_scaling': shared / single,
+    }
+
+
+def bench_memory(app, args):
+    """Memory held by download_progress per job, and what is left after the janitor expires them"""
+    ids = [f'bench-memory-{i}' for i in range(args.memory_jobs)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for download_id in ids:
+        app.update_progress(download_id, 'downloading', 50, 'Downloading: bench', 1, 1, 'bench')
+    tracked = tracemalloc.take_snapshot()
+    for download_id in ids:
+        app.update_progress(download_id, 'finished', 100, 'Download completed!')
+    finished = tracemalloc.take_snapshot()
+    expired = expire_all_jobs(app)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    if expired is None:
+        forget_jobs(app, ids)
+
+    def growth(snapshot):
+        return sum(stat.size_diff for stat in snapshot.compare_to(before, 'filename'))
+
+    return {
+        'jobs': args.memory_jobs,
+        'bytes_per_tracked_job': growth(tracked) / args.memory_jobs,
+        'bytes_per_finished_job': growth(finished) / args.memory_jobs,
+        'expired_jobs': expired,
+        'bytes_retained_after_expiry': growth(after) if expired is not None else None,
+    }
+
+
+def run_benchmarks(args):
+    config_dir = tempfile.mkdtemp(prefix='bench-config-')
+    download_dir = tempfile.mkdtemp(prefix='bench-downloads-')
+    try:
+        app = load_app(config_dir, args)
+        results = {}
+        with FakeMediaServer() as server:
+            for name in args.only or BENCHMARKS:
+                missing = [hook for hook in REQUIRED_HOOKS.get(name, ()) if not hasattr(app, hook)]
+                if missing:
+                    print(f'Skipping {name}: app has no {", ".join(missing)}', file=sys.stderr)
+                    results[name] = {'skipped': f'app has no {", ".join(missing)}'}
+                    continue
+                print(f'Running {name}...', file=sys.stderr)
+                if name == 'jobs':
+                    results[name] = bench_jobs(app, server, download_dir, args)
+                elif name == 'progress_polling':
+                    results[name] = bench_progress_polling(app, args)
+                elif name == 'update_progress':
+                    results[name] = bench_update_progress(app, args)
+                elif name == 'memory':
+                    results[name] = bench_memory(app, args)
+        return results
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def compare(old_path, new_path):
+    """Print every numeric result of two runs side by side with the relative change"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def flatten(data, prefix=''):
+        for key, value in data.items():
+            if isinstance(value, dict):
+                yield from flatten(value, f'{prefix}{key}.')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f'{prefix}{key}', value
+
+    old_values = dict(flatten(old['results']))
+    print(f"{'metric':60} {old.get('commit') or 'old':>14} {new.get('commit') or 'new':>14} {'change':>9}")
+    for key, value in flatten(new['results']):
+        previous = old_values.get(key)
+        change = f'{(value - previous) / previous * 100:+.1f}%' if previous else ''
+        previous = f'{previous:.6g}' if previous is not None else '-'
+        print(f'{key:60} {previous:>14} {value:>14.6g} {change:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark app.py against a local fake media server')
+    parser.add_argument('--output', help='write the JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='run only these benchmarks')
+    parser.add_argument('--quick', action='store_true', help='small sizes for a fast smoke run')
+    parser.add_argument('--jobs', type=int, default=50, help='single-video jobs to download')
+    parser.add_argument('--workers', type=int, default=3, help='MAX_CONCURRENT_DOWNLOADS for the run')
+    parser.add_argument('--media-size', type=int, default=1024 * 1024, help='bytes per synthetic video')
+    parser.add_argument('--playlist-items', type=int, default=10)
+    parser.add_argument('--pollers', type=int, default=16, help='concurrent /progress pollers')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of /progress polling')
+    parser.add_argument('--threads', type=int, default=8, help='threads calling update_progress')
+    parser.add_argument('--updates', type=int, default=20000, help='update_progress calls per thread')
+    parser.add_argument('--memory-jobs', type=int, default=10000, help='job records for the memory benchmark')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for download jobs')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.quick:
+        args.jobs, args.playlist_items, args.duration = 5, 3, 1.0
+        args.updates, args.memory_jobs = 2000, 1000
+
+    results = run_benchmarks(args)
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
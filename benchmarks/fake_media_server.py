@@ -0,0 +1,134 @@
+"""Local stand-in for a video site, used by the benchmarks.
+
+Serves synthetic media that yt-dlp's generic extractor understands, with no network access:
+
+    /media/<name>.mp4?size=<bytes>      a direct video file (supports HEAD and Range requests)
+    /playlist/<name>?items=<n>&size=<bytes>
+                                        an HTML page with <n> <video> tags, extracted as a playlist
+
+Adding `fail=<n>` to a media URL makes its first <n> GET requests fail with 503, to exercise retries.
+
+Run it on its own with `python benchmarks/fake_media_server.py --port 8765`.
+"""
+import argparse
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_SIZE = 1024 * 1024
+CHUNK = 64 * 1024
+PATTERN = bytes(range(256)) * (CHUNK // 256)  # synthetic payload, repeated up to the requested size
+
+
+class FakeMediaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    failures = {}  # path with ?fail=<n> -> failed requests so far
+    failures_lock = threading.Lock()
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        size = int(query.get('size', [DEFAULT_SIZE])[0])
+        if parts.path.startswith('/media/'):
+            fail = int(query.get('fail', [0])[0])
+            if fail and send_body:
+                with self.failures_lock:
+                    failed = self.failures.get(self.path, 0)
+                    self.failures[self.path] = failed + 1
+                if failed < fail:
+                    self.send_error(503)
+                    return
+            self.send_media(size, send_body)
+        elif parts.path.startswith('/playlist/'):
+            name = parts.path[len('/playlist/'):] or 'playlist'
+            items = int(query.get('items', [3])[0])
+            videos = ''.join(f'<video src="/media/{name}-{i}.mp4?size={size}"></video>' for i in range(1, items + 1))
+            body = f'<html><head><title>{name}</title></head><body>{videos}</body></html>'.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def send_media(self, size, send_body):
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+        remaining = end - start + 1
+        try:
+            while remaining > 0:
+                chunk = PATTERN[:min(CHUNK, remaining)]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMediaServer:
+    """Fake media server running on a background thread"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.httpd = ThreadingHTTPServer((host, port), FakeMediaHandler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-media-server', daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def media_url(self, name, size=DEFAULT_SIZE, fail=0):
+        url = f'{self.base_url}/media/{name}.mp4?size={size}'
+        return f'{url}&fail={fail}' if fail else url
+
+    def playlist_url(self, name, items, size=DEFAULT_SIZE):
+        return f'{self.base_url}/playlist/{name}?items={items}&size={size}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic media and playlists for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    with FakeMediaServer(args.host, args.port) as server:
+        print(f'Serving fake media on {server.base_url}')
+        server.thread.join()